@@ -0,0 +1,172 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import buffer_storage
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+SAMPLE_RATE = 100
+
+
+def pcm(start, stop):
+    """Consecutive samples, so any slice of the stream is easy to check"""
+    return np.arange(start, stop, dtype=np.int16)
+
+
+class BufferStorageTests:
+    """Behaviour both backends share. Subclasses provide make_storage."""
+
+    async def asyncSetUp(self):
+        # One second of audio at SAMPLE_RATE, so the ring wraps quickly
+        self.storage = self.make_storage(max_duration=1)
+        self.addAsyncCleanup(self.storage.close)
+
+    async def test_append_wraps_around_with_odd_byte_chunks(self):
+        data = pcm(0, 250).tobytes()
+        pos = 0
+        for size in [7, 1, 13, 2, 99, 3] * 20:
+            if pos >= len(data):
+                break
+            duration = await self.storage.append('user', SAMPLE_RATE, data[pos:pos + size])
+            pos += size
+
+        self.assertEqual(duration, 1.0)
+        np.testing.assert_array_equal(await self.storage.tail('user', 1), pcm(150, 250))
+        np.testing.assert_array_equal(await self.storage.tail('user', 0.1), pcm(240, 250))
+
+    async def test_odd_trailing_byte_is_held_back(self):
+        data = pcm(0, 10).tobytes()
+        await self.storage.append('user', SAMPLE_RATE, data[:5])
+        np.testing.assert_array_equal(await self.storage.tail('user', 1), pcm(0, 2))
+        await self.storage.append('user', SAMPLE_RATE, data[5:])
+        np.testing.assert_array_equal(await self.storage.tail('user', 1), pcm(0, 10))
+
+    async def test_read_new_audio_and_add_hashes(self):
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 50).tobytes())
+
+        samples, start, sample_rate, processed = await self.storage.read_new_audio('user', 0.1)
+        np.testing.assert_array_equal(samples, pcm(0, 50))
+        self.assertEqual((start, sample_rate, processed), (0, SAMPLE_RATE, 0))
+        hashes = await self.storage.add_hashes('user', [(1, 0.1), (2, 0.45)], sample_rate, processed, 50)
+        self.assertEqual([tuple(h) for h in hashes], [(1, 0.1), (2, 0.45)])
+
+        # Only the new audio, plus the overlap, is read the second time
+        await self.storage.append('user', SAMPLE_RATE, pcm(50, 80).tobytes())
+        samples, start, _, processed = await self.storage.read_new_audio('user', 0.1)
+        np.testing.assert_array_equal(samples, pcm(40, 80))
+        self.assertEqual((start, processed), (40, 50))
+
+        # Hashes in the overlap were already added
+        hashes = await self.storage.add_hashes('user', [(3, 0.45), (4, 0.6)], SAMPLE_RATE, processed, 80)
+        self.assertEqual([tuple(h) for h in hashes], [(1, 0.1), (2, 0.45), (4, 0.6)])
+
+        # A stale read is refused
+        self.assertIsNone(await self.storage.add_hashes('user', [(5, 0.7)], SAMPLE_RATE, processed, 80))
+
+    async def test_add_hashes_after_sample_rate_change(self):
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 50).tobytes())
+        samples, start, sample_rate, processed = await self.storage.read_new_audio('user', 0.1)
+
+        # The buffer is replaced while the old audio is fingerprinted
+        await self.storage.append('user', 2 * SAMPLE_RATE, pcm(0, 10).tobytes())
+        self.assertIsNone(await self.storage.add_hashes('user', [(1, 0.1)], sample_rate, processed, 50))
+        # and again, back to the old rate
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 10).tobytes())
+        self.assertIsNone(await self.storage.add_hashes('user', [(1, 0.1)], sample_rate, processed, 50))
+
+        samples, start, _, processed = await self.storage.read_new_audio('user', 0.1)
+        np.testing.assert_array_equal(samples, pcm(0, 10))
+        self.assertEqual((start, processed), (0, 0))
+
+    async def test_add_hashes_after_clear(self):
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 50).tobytes())
+        samples, start, sample_rate, processed = await self.storage.read_new_audio('user', 0.1)
+
+        await self.storage.append('user', SAMPLE_RATE, pcm(50, 60).tobytes())
+        await self.storage.clear('user')
+        self.assertIsNone(await self.storage.add_hashes('user', [(1, 0.1)], sample_rate, processed, 50))
+        self.assertEqual((await self.storage.read_new_audio('user', 0.1))[3], 60)
+
+    async def test_clear_keeps_stream_time(self):
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 50).tobytes())
+        await self.storage.set_fields('user', last_song='song')
+        await self.storage.clear('user')
+
+        await self.storage.append('user', SAMPLE_RATE, pcm(50, 60).tobytes())
+        samples, start, _, processed = await self.storage.read_new_audio('user', 0.1)
+        np.testing.assert_array_equal(samples, pcm(50, 60))
+        self.assertEqual((start, processed), (50, 50))
+        self.assertEqual(await self.storage.get_fields('user', 'last_song'), {'last_song': 'song'})
+
+    async def test_read_new_audio_without_buffer(self):
+        self.assertIsNone(await self.storage.read_new_audio('nobody', 0.1))
+
+    async def test_claim_and_release(self):
+        await self.storage.append('user', SAMPLE_RATE, pcm(0, 10).tobytes())
+
+        self.assertTrue(await self.storage.claim('user'))
+        self.assertFalse(await self.storage.claim('user'))
+        await self.storage.release('user')
+        self.assertTrue(await self.storage.claim('user'))
+
+    async def test_count_and_delete(self):
+        await self.storage.append('a', SAMPLE_RATE, pcm(0, 10).tobytes())
+        await self.storage.append('b', SAMPLE_RATE, pcm(0, 10).tobytes())
+        self.assertEqual(await self.storage.count(), 2)
+
+        self.assertTrue(await self.storage.delete('a'))
+        self.assertFalse(await self.storage.delete('a'))
+        self.assertEqual(await self.storage.count(), 1)
+        self.assertIsNone(await self.storage.stats('a'))
+        self.assertEqual((await self.storage.stats('b'))['buffer_size_bytes'], 20)
+
+
+class LocalBufferStorageTest(BufferStorageTests, unittest.IsolatedAsyncioTestCase):
+    def make_storage(self, max_duration):
+        return buffer_storage.LocalBufferStorage(max_duration, ttl=120, max_users=2)
+
+    async def test_least_recently_used_is_evicted(self):
+        await self.storage.append('a', SAMPLE_RATE, pcm(0, 10).tobytes())
+        await self.storage.append('b', SAMPLE_RATE, pcm(0, 10).tobytes())
+        await self.storage.append('a', SAMPLE_RATE, pcm(10, 20).tobytes())
+        await self.storage.append('c', SAMPLE_RATE, pcm(0, 10).tobytes())
+
+        self.assertEqual(await self.storage.count(), 2)
+        self.assertIsNone(await self.storage.stats('b'))
+        np.testing.assert_array_equal(await self.storage.tail('a', 1), pcm(0, 20))
+
+    async def test_sweep_drops_idle_buffers(self):
+        await self.storage.append('a', SAMPLE_RATE, pcm(0, 10).tobytes())
+        with mock.patch.object(buffer_storage.time, 'monotonic', return_value=1e12):
+            await self.storage.append('b', SAMPLE_RATE, pcm(0, 10).tobytes())
+            self.assertEqual(await self.storage.sweep(), 1)
+        self.assertIsNone(await self.storage.stats('a'))
+        self.assertEqual(await self.storage.count(), 1)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisBufferStorageTest(BufferStorageTests, unittest.IsolatedAsyncioTestCase):
+    def make_storage(self, max_duration):
+        with mock.patch.object(buffer_storage.redis, 'from_url', lambda url: fakeredis.FakeAsyncRedis()):
+            return buffer_storage.RedisBufferStorage('redis://fake', max_duration, ttl=120)
+
+    async def test_expired_users_are_not_counted(self):
+        await self.storage.append('a', SAMPLE_RATE, pcm(0, 10).tobytes())
+        with mock.patch.object(buffer_storage.time, 'time', return_value=buffer_storage.time.time() + 1000):
+            await self.storage.append('b', SAMPLE_RATE, pcm(0, 10).tobytes())
+            self.assertEqual(await self.storage.count(), 1)
+            self.assertEqual(await self.storage.sweep(), 1)
+        self.assertEqual(await self.storage.client.zcard(self.storage.ACTIVE_KEY), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
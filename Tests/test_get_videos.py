@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'dataset'))
+
+import get_videos
+
+
+def fake_register(downloaded_filepath, song_info):
+    """Stands in for :func:`get_videos.register_track` in the recognise pool."""
+    return os.path.exists(downloaded_filepath)
+
+
+class ProcessTracksTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.addCleanup(self.scratch.cleanup)
+        self.log_path = os.path.join(self.scratch.name, 'successful_recognitions.txt')
+
+    def fake_download(self, query):
+        # Slow enough that downloads are still running when the last track is submitted
+        time.sleep(0.05)
+        path = os.path.join(self.scratch.name, f"{abs(hash(query))}.webm")
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+        return path
+
+    def test_every_track_reaches_recognition(self):
+        tracks = [
+            {'artist': f'Artist {i}', 'album_name': 'Album', 'track_name': f'Track {i}'}
+            for i in range(10)
+        ]
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            with mock.patch.object(get_videos, 'download_with_retries', self.fake_download), \
+                    mock.patch.object(get_videos, 'register_track', fake_register):
+                get_videos.process_tracks(tracks, fd, net_workers=3, recognise_workers=2)
+        finally:
+            os.close(fd)
+
+        self.assertEqual(get_videos.load_completed(self.log_path),
+                         {get_videos.search_query(t) for t in tracks})
+        # Each download is deleted once it has been registered
+        self.assertEqual(os.listdir(self.scratch.name), ['successful_recognitions.txt'])
+
+
+class GetTrackNamesTest(unittest.TestCase):
+    def test_missing_popularity_sorts_last(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            csv_filepath = os.path.join(scratch, 'tracks.csv')
+            with open(csv_filepath, 'w') as f:
+                f.write('track_name,artists,album_name,popularity\n'
+                        'A,x,y,\n'
+                        'B,x,y,10\n'
+                        'A,x,z,5\n'
+                        'C,x,y,\n')
+            with mock.patch.object(get_videos, 'PYARROW_AVAILABLE', False):
+                tracks = get_videos.get_track_names_from_csv(csv_filepath, chunksize=2)
+
+        self.assertEqual([(t['track_name'], t['album_name']) for t in tracks],
+                         [('B', 'y'), ('A', 'z'), ('C', 'y')])
+
+
+if __name__ == '__main__':
+    unittest.main()
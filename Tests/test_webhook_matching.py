@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import omi_song_recognition_webhook as webhook
+
+# A song whose hash h occurs once, h / 10 seconds in
+SONG = {h: [h / 10] for h in range(100)}
+
+
+def heard(hashes, delta):
+    """The song's hashes as heard in a user's buffer, delta seconds after the song's own offsets"""
+    return [(h, SONG[h][0] + delta) for h in hashes]
+
+
+class CalculateConfidenceTest(unittest.TestCase):
+    def test_too_few_aligned_hashes(self):
+        self.assertEqual(webhook.calculate_confidence(webhook.MIN_MATCH_SCORE - 1, webhook.MIN_MATCH_SCORE), 0.1)
+
+    def test_thresholds_are_upper_bounds(self):
+        for score, confidence in [(10, 0.1), (15, 0.1), (16, 0.4), (30, 0.4), (31, 0.7),
+                                  (50, 0.7), (51, 0.9), (100, 0.9), (101, 1.0), (1000, 1.0)]:
+            with self.subTest(score=score):
+                self.assertEqual(webhook.calculate_confidence(score, 1000), confidence)
+
+
+@mock.patch.object(webhook, 'song_hashes', lambda song_id: SONG)
+class AlignmentTest(unittest.TestCase):
+    def test_song_alignment(self):
+        # The largest bin wins over a few hashes that line up elsewhere
+        fingerprints = heard(range(50), 20.0) + heard(range(50, 60), 3.0)
+        self.assertAlmostEqual(webhook.song_alignment('song', fingerprints), 20.0)
+
+    def test_song_alignment_without_shared_hashes(self):
+        self.assertIsNone(webhook.song_alignment('song', [(1000, 1.0)]))
+
+    def test_still_playing_when_aligned(self):
+        recent = heard(range(60, 80), 20.2)
+        self.assertTrue(webhook.still_playing('song', 20.0, recent))
+
+    def test_not_still_playing_when_misaligned(self):
+        # The same hashes, but from further along than the song could have played
+        recent = heard(range(60, 80), 20.0 + 2 * webhook.ALIGNMENT_TOLERANCE)
+        self.assertFalse(webhook.still_playing('song', 20.0, recent))
+
+    def test_not_still_playing_when_scattered(self):
+        recent = [(h, SONG[h][0] + 20.0 + h % 7) for h in range(60, 80)]
+        self.assertFalse(webhook.still_playing('song', 20.0, recent))
+
+
+class MissingSongTest(unittest.TestCase):
+    def test_song_without_hashes(self):
+        with mock.patch.object(webhook, 'song_hashes', side_effect=LookupError):
+            self.assertIsNone(webhook.song_alignment('song', heard(range(50), 20.0)))
+            self.assertFalse(webhook.still_playing('song', 20.0, heard(range(50), 20.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
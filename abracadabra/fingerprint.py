@@ -1,4 +1,6 @@
 import uuid
+import math
+import functools
 import logging
 import subprocess
 import tempfile
@@ -6,14 +8,41 @@ import os
 import numpy as np
 from . import settings
 from pydub import AudioSegment
-from scipy.signal import spectrogram
+from scipy.signal import spectrogram, resample_poly, get_window, firwin
 from scipy.ndimage import maximum_filter
 
 
+@functools.lru_cache(maxsize=None)
+def spectrogram_window(nperseg):
+    """Helper function that computes the window :func:`my_spectrogram` uses once per size.
+
+    This is ``scipy.signal.spectrogram``'s default window, so spectrograms are unchanged.
+    """
+    window = get_window(('tukey', 0.25), nperseg)
+    window.setflags(write=False)
+    return window
+
+
+@functools.lru_cache(maxsize=None)
+def resample_filter(up, down):
+    """Helper function that designs the FIR filter for resampling by `up`/`down` once per ratio.
+
+    This is the filter ``scipy.signal.resample_poly`` designs by default, in single precision
+    to match :func:`fingerprint_samples`.
+    """
+    max_rate = max(up, down)
+    fir = firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+    fir.setflags(write=False)
+    return fir
+
+
 def my_spectrogram(audio):
     """Helper function that performs a spectrogram with the values in settings."""
     nperseg = int(settings.SAMPLE_RATE * settings.FFT_WINDOW_SIZE)
-    return spectrogram(audio, settings.SAMPLE_RATE, nperseg=nperseg)
+    if len(audio) < nperseg:
+        # scipy shrinks the segment to fit, so the cached window wouldn't fit either
+        return spectrogram(audio, settings.SAMPLE_RATE, nperseg=nperseg)
+    return spectrogram(audio, settings.SAMPLE_RATE, window=spectrogram_window(nperseg), nperseg=nperseg)
 
 
 def file_to_spectrogram(filename):
@@ -39,9 +68,11 @@ def file_to_spectrogram(filename):
                 tmp_filename = tmp.name
 
             try:
-                # Convert ADPCM to PCM using ffmpeg
-                cmd = ['ffmpeg', '-i', filename, '-acodec', 'pcm_s16le', '-y', tmp_filename]
-                subprocess.run(cmd, check=True, capture_output=True)
+                # Convert ADPCM to PCM using ffmpeg. Only errors are logged, and stdout is
+                # discarded, so nothing but the error text is buffered in memory.
+                cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filename,
+                       '-acodec', 'pcm_s16le', '-y', tmp_filename]
+                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
                 # Load the converted file
                 a = AudioSegment.from_file(tmp_filename).set_channels(1).set_frame_rate(settings.SAMPLE_RATE)
@@ -56,6 +87,25 @@ def file_to_spectrogram(filename):
     return my_spectrogram(audio)
 
 
+def file_to_audio(filename, timeout=None):
+    """Decodes a file straight into memory with ffmpeg.
+
+    ffmpeg converts the file to mono 16-bit PCM at :data:`~abracadabra.settings.SAMPLE_RATE`
+    and writes the raw samples to a pipe, so no intermediate WAV file is written or parsed.
+    The result can be passed to :func:`fingerprint_audio`.
+
+    :param filename: Path to the file to decode.
+    :param timeout: Seconds to allow ffmpeg before it is killed and
+                    ``subprocess.TimeoutExpired`` is raised (optional).
+    :returns: The decoded audio as a numpy ``int16`` array.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filename,
+           '-f', 's16le', '-ac', '1', '-ar', str(settings.SAMPLE_RATE), 'pipe:1']
+    result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=timeout)
+    return np.frombuffer(result.stdout, np.int16)
+
+
 def find_peaks(Sxx):
     """Finds peaks in a spectrogram.
 
@@ -68,7 +118,8 @@ def find_peaks(Sxx):
     <https://photutils.readthedocs.io/en/stable/_modules/photutils/detection/core.html#find_peaks>`_.
 
     :param Sxx: The spectrogram.
-    :returns: A list of peaks in the spectrogram.
+    :returns: An array of (frequency index, time index) rows for the peaks in the spectrogram,
+              strongest first.
     """
     data_max = maximum_filter(Sxx, size=settings.PEAK_BOX_SIZE, mode='constant', cval=0.0)
     peak_goodmask = (Sxx == data_max)  # good pixels are True
@@ -76,7 +127,7 @@ def find_peaks(Sxx):
     peak_values = Sxx[y_peaks, x_peaks]
     i = peak_values.argsort()[::-1]
     # get co-ordinates into arr
-    j = [(y_peaks[idx], x_peaks[idx]) for idx in i]
+    j = np.column_stack((y_peaks[i], x_peaks[i]))
     total = Sxx.shape[0] * Sxx.shape[1]
     # in a square with a perfectly spaced grid, we could fit area / PEAK_BOX_SIZE^2 points
     # use point efficiency to reduce this, since it won't be perfectly spaced
@@ -87,7 +138,7 @@ def find_peaks(Sxx):
 
 def idxs_to_tf_pairs(idxs, t, f):
     """Helper function to convert time/frequency indices into values."""
-    return np.array([(f[i[0]], t[i[1]]) for i in idxs])
+    return np.column_stack((f[idxs[:, 0]], t[idxs[:, 1]]))
 
 
 def hash_point_pair(p1, p2):
@@ -99,26 +150,23 @@ def target_zone(anchor, points, width, height, t):
     """Generates a target zone as described in `the Shazam paper
     <https://www.ee.columbia.edu/~dpwe/papers/Wang03-shazam.pdf>`_.
 
-    Given an anchor point, yields all points within a box that starts `t` seconds after the point,
-    and has width `width` and height `height`.
+    Given an anchor point, finds all points within a box that starts `t` seconds after the point,
+    and has width `width` and height `height`. The box is checked against every point at once
+    with numpy, rather than point by point.
 
     :param anchor: The anchor point
-    :param points: The list of points to search
+    :param points: The array of points to search, one (frequency, time) row per point
     :param width: The width of the target zone
     :param height: The height of the target zone
     :param t: How many seconds after the anchor point the target zone should start
-    :returns: Yields all points within the target zone.
+    :returns: The points within the target zone, in the order given.
     """
     x_min = anchor[1] + t
     x_max = x_min + width
     y_min = anchor[0] - (height*0.5)
     y_max = y_min + height
-    for point in points:
-        if point[0] < y_min or point[0] > y_max:
-            continue
-        if point[1] < x_min or point[1] > x_max:
-            continue
-        yield point
+    y, x = points[:, 0], points[:, 1]
+    return points[(y >= y_min) & (y <= y_max) & (x >= x_min) & (x <= x_max)]
 
 
 def hash_points(points, filename):
@@ -132,6 +180,7 @@ def hash_points(points, filename):
     """
     hashes = []
     song_id = uuid.uuid5(uuid.NAMESPACE_OID, filename).int
+    points = np.asarray(points).reshape(-1, 2)
     for anchor in points:
         for target in target_zone(
             anchor, points, settings.TARGET_T, settings.TARGET_F, settings.TARGET_START
@@ -147,29 +196,52 @@ def hash_points(points, filename):
     return hashes
 
 
-def fingerprint_file(filename):
+def fingerprint_file(filename, name=None):
     """Generate hashes for a file.
 
     Given a file, runs it through the fingerprint process to produce a list of hashes from it.
 
     :param filename: The path to the file.
+    :param name: The name used to generate the song_id of the hashes, if not the path.
     :returns: The output of :func:`hash_points`.
     """
     f, t, Sxx = file_to_spectrogram(filename)
     peaks = find_peaks(Sxx)
     peaks = idxs_to_tf_pairs(peaks, t, f)
-    return hash_points(peaks, filename)
+    return hash_points(peaks, filename if name is None else name)
 
 
-def fingerprint_audio(frames):
+def fingerprint_audio(frames, filename="recorded"):
     """Generate hashes for a series of audio frames.
 
-    Used when recording audio.
+    Used when recording audio, or with audio decoded by :func:`file_to_audio`.
 
     :param frames: A mono audio stream. Data type is any that ``scipy.signal.spectrogram`` accepts.
+    :param filename: The name used to generate the song_id of the hashes.
     :returns: The output of :func:`hash_points`.
     """
     f, t, Sxx = my_spectrogram(frames)
     peaks = find_peaks(Sxx)
     peaks = idxs_to_tf_pairs(peaks, t, f)
-    return hash_points(peaks, "recorded")
+    return hash_points(peaks, filename)
+
+
+def fingerprint_samples(samples, sample_rate, filename="recorded"):
+    """Generate hashes for mono audio samples recorded at any sample rate.
+
+    The samples are resampled to :data:`~abracadabra.settings.SAMPLE_RATE` first, so the
+    hashes are comparable with those of registered songs. Resampling and the spectrogram
+    are done in single precision, which is plenty for 16-bit audio and halves the memory
+    traffic of the double precision scipy would otherwise use.
+
+    :param samples: A mono audio stream as a numpy array, e.g. 16-bit PCM.
+    :param sample_rate: The sample rate of `samples` in Hz.
+    :param filename: The name used to generate the song_id of the hashes.
+    :returns: The output of :func:`hash_points`.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if sample_rate != settings.SAMPLE_RATE:
+        g = math.gcd(sample_rate, settings.SAMPLE_RATE)
+        up, down = settings.SAMPLE_RATE // g, sample_rate // g
+        samples = resample_poly(samples, up, down, window=resample_filter(up, down))
+    return fingerprint_audio(samples, filename)
@@ -60,6 +60,33 @@ def register_song(filename):
         return
     hashes = fingerprint_file(filename)
     song_info = get_song_info(filename)
+    write_song(hashes, song_info, filename)
+
+
+def register_audio(frames, filename, song_info):
+    """Register a song from audio that has already been decoded.
+
+    Like :func:`register_song`, but takes the audio (e.g. from
+    :func:`~abracadabra.fingerprint.file_to_audio`) and song information directly
+    instead of reading them from the file.
+
+    :param frames: Mono audio at :data:`~abracadabra.settings.SAMPLE_RATE`.
+    :param filename: The path the audio came from, used to generate the song_id.
+    :param song_info: A tuple of form (artist, album, title) describing the song.
+    """
+    if song_in_db(filename):
+        return
+    hashes = fingerprint_audio(frames, filename)
+    write_song(hashes, song_info, filename)
+
+
+def write_song(hashes, song_info, filename):
+    """Store a fingerprinted song, holding the pool's lock if running in one.
+
+    :param hashes: The hashes to store.
+    :param song_info: A tuple of form (artist, album, title) describing the song.
+    :param filename: The path of the song, used in log messages.
+    """
     try:
         logging.info(f"{current_process().name} waiting to write {filename}")
         with lock:
@@ -134,6 +161,17 @@ def best_match(matches):
     :returns: song_id with the best score.
     :rtype: str
     """
+    return best_match_with_score(matches)[0]
+
+
+def best_match_with_score(matches):
+    """For a dictionary of song_id: offsets, returns the best song_id and its score.
+
+    :param matches: Dictionary of song_id to list of offset pairs (db_offset, sample_offset)
+       as returned by :func:`~abracadabra.Storage.storage.get_matches`.
+    :returns: song_id with the best score (or None) and that score.
+    :rtype: tuple(str, int)
+    """
     matched_song = None
     best_score = 0
     for song_id, offsets in matches.items():
@@ -144,29 +182,44 @@ def best_match(matches):
         if score > best_score:
             best_score = score
             matched_song = song_id
-    return matched_song
+    return matched_song, best_score
 
 
-def recognise_song(filename):
+def recognise_song(filename, with_score=False):
     """Recognises a pre-recorded sample.
 
     Recognises the sample stored at the path ``filename``. The sample can be in any of the
     formats in :data:`recognise.KNOWN_FORMATS`.
 
     :param filename: Path of file to be recognised.
-    :returns: :func:`~abracadabra.recognise.get_song_info` result for matched song or None.
+    :param with_score: Also return the match score, from the same fingerprinting pass.
+    :returns: :func:`~abracadabra.recognise.get_song_info` result for matched song or None,
+              paired with the score if ``with_score`` is set.
     :rtype: tuple(str, str, str)
     """
     hashes = fingerprint_file(filename)
+    return match_hashes(hashes, with_score)
+
+
+def match_hashes(hashes, with_score=False):
+    """Finds the registered song that best matches a sample's hashes.
+
+    :param hashes: Hashes of the sample, as returned by :func:`~abracadabra.fingerprint.hash_points`.
+    :param with_score: Also return the match score.
+    :returns: :func:`~abracadabra.recognise.get_song_info` result for matched song or None,
+              paired with the score if ``with_score`` is set.
+    """
     matches = get_matches(hashes)
-    matched_song = best_match(matches)
+    matched_song, score = best_match_with_score(matches)
     info = get_info_for_song_id(matched_song)
-    if info is not None:
-        return info
-    return matched_song
+    if info is None:
+        info = matched_song
+    if with_score:
+        return info, score
+    return info
 
 
-def listen_to_song(filename=None):
+def listen_to_song(filename=None, with_score=False):
     """Recognises a song using the microphone.
 
     Optionally saves the sample recorded using the path provided for use in future tests.
@@ -174,16 +227,13 @@ def listen_to_song(filename=None):
     into :func:`~abracadabra.record.gen_many_tests`.
 
     :param filename: The path to store the recorded sample (optional)
-    :returns: :func:`~abracadabra.recognise.get_song_info` result for matched song or None.
+    :param with_score: Also return the match score.
+    :returns: :func:`~abracadabra.recognise.get_song_info` result for matched song or None,
+              paired with the score if ``with_score`` is set.
     :rtype: tuple(str, str, str)
     """
     # Import record_audio only when needed (requires pyaudio)
     from .record import record_audio
     audio = record_audio(filename=filename)
     hashes = fingerprint_audio(audio)
-    matches = get_matches(hashes)
-    matched_song = best_match(matches)
-    info = get_info_for_song_id(matched_song)
-    if info is not None:
-        return info
-    return matched_song
+    return match_hashes(hashes, with_score)
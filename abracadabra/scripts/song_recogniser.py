@@ -22,12 +22,18 @@ def register(path):
 @click.argument("path", required=False)
 @click.option("--listen", is_flag=True,
               help="Use the microphone to listen for a song")
-def recognise(path, listen):
+@click.option("--with-score", is_flag=True,
+              help="Also print the match score, as 'Score: N'")
+def recognise(path, listen, with_score):
     if listen:
-        result = recog.listen_to_song()
+        result = recog.listen_to_song(with_score=with_score)
+    else:
+        result = recog.recognise_song(path, with_score=with_score)
+    if with_score:
+        result, score = result
         click.echo(result)
+        click.echo(f"Score: {score}")
     else:
-        result = recog.recognise_song(path)
         click.echo(result)
 
 
@@ -0,0 +1,19 @@
+""" Helpers shared by the library, the dataset scripts and the webhook. """
+
+import os
+
+
+def available_cpu_count():
+    """Get the number of CPUs this process may actually run on.
+
+    Unlike ``os.cpu_count()`` this respects affinity masks (taskset, SLURM, container
+    cpusets), so pools aren't oversized on restricted hosts.
+
+    :returns: The number of usable CPUs, at least 1.
+    :rtype: int
+    """
+    if hasattr(os, 'process_cpu_count'):
+        return os.process_cpu_count() or 1
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
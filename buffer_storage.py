@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+"""
+Per-user audio buffer storage for the Omi webhook
+Buffers live in this process by default, or in Redis so several workers can share them
+"""
+
+import json
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import redis.asyncio as redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Record layout of the fingerprint hashes kept with a buffer in Redis
+HASH_DTYPE = np.dtype([('hash', '<i8'), ('offset', '<f8')])
+
+
+def new_audio_buffer(sample_rate: int, max_duration: int) -> dict:
+    """
+    Create a user's audio buffer entry.
+
+    Audio is held as 16-bit samples in a preallocated ring buffer of max_duration
+    seconds, so appending never reallocates and the oldest audio is overwritten
+    once full. Alongside it are the fingerprint hashes of the buffered audio,
+    extended as new audio arrives (see add_hashes).
+
+    Args:
+        sample_rate: Sample rate of the incoming audio in Hz
+        max_duration: Length of the ring buffer (seconds)
+
+    Returns:
+        Buffer entry
+    """
+    return {
+        'buf': np.zeros(max_duration * sample_rate, dtype=np.int16),
+        'write': 0,
+        'filled': 0,
+        'partial': b'',
+        'total': 0,
+        'processed': 0,
+        'hashes': [],
+        'sample_rate': sample_rate,
+        'last_recognition': None
+    }
+
+
+def buffer_append(buffer_info: dict, audio_bytes: bytes):
+    """
+    Append audio to a user's ring buffer, overwriting the oldest audio when full.
+
+    Args:
+        buffer_info: Buffer entry from new_audio_buffer
+        audio_bytes: Raw audio bytes to append
+    """
+    # Hold back an odd trailing byte until the rest of its sample arrives
+    if buffer_info['partial']:
+        audio_bytes = buffer_info['partial'] + audio_bytes
+    whole = len(audio_bytes) - len(audio_bytes) % 2
+    buffer_info['partial'] = audio_bytes[whole:]
+
+    buf = buffer_info['buf']
+    capacity = len(buf)
+    data = np.frombuffer(audio_bytes, dtype=np.int16, count=whole // 2)[-capacity:]
+    n = len(data)
+
+    write = buffer_info['write']
+    first = min(n, capacity - write)
+    buf[write:write + first] = data[:first]
+    buf[:n - first] = data[first:]
+
+    buffer_info['write'] = (write + n) % capacity
+    buffer_info['filled'] = min(buffer_info['filled'] + n, capacity)
+    buffer_info['total'] += whole // 2
+
+
+def buffer_clear(buffer_info: dict):
+    """Empty a user's ring buffer and its hashes without freeing the buffer"""
+    buffer_info['write'] = 0
+    buffer_info['filled'] = 0
+    buffer_info['partial'] = b''
+    buffer_info['processed'] = buffer_info['total']
+    buffer_info['hashes'] = []
+
+
+def buffer_since(buffer_info: dict, start: int) -> np.ndarray:
+    """
+    Get a user's buffered audio from a given sample onwards as 16-bit samples.
+
+    Args:
+        buffer_info: Buffer entry from new_audio_buffer
+        start: Index of the first sample to return, counted from the start of
+               the stream. Audio the ring has already overwritten is skipped.
+
+    Returns:
+        The audio from start onwards, as int16 samples. This is a view into the
+        buffer unless the audio wraps around its end.
+    """
+    buf = buffer_info['buf']
+    write = buffer_info['write']
+    n = max(0, min(buffer_info['total'] - start, buffer_info['filled']))
+    first = write - n
+    if first >= 0:
+        return buf[first:write]
+    return np.concatenate((buf[first:], buf[:write]))
+
+
+class LocalBufferStorage:
+    """
+    Audio buffers held in this process's memory.
+
+    Every method is a coroutine so this is interchangeable with RedisBufferStorage.
+    Buffers are only visible to the worker that received the audio. Entries are kept
+    in least recently used order: once there are max_users the least recently used
+    is dropped, and sweep drops those idle for longer than ttl.
+    """
+
+    def __init__(self, max_duration: int, ttl: int = 120, max_users: int = 1000):
+        """
+        Args:
+            max_duration: Seconds of audio to keep per user
+            ttl: Seconds without audio after which sweep drops a user's buffer
+            max_users: Most buffers to keep at once
+        """
+        self.max_duration = max_duration
+        self.ttl = ttl
+        self.max_users = max_users
+        self.entries = OrderedDict()
+
+    async def append(self, uid: str, sample_rate: int, audio_bytes: bytes) -> float:
+        """
+        Append audio to a user's buffer, creating it (or replacing it if the sample rate changed).
+
+        Returns:
+            Seconds of audio now buffered
+        """
+        buffer_info = self.entries.get(uid)
+        if buffer_info is None or buffer_info['sample_rate'] != sample_rate:
+            buffer_info = self.entries[uid] = new_audio_buffer(sample_rate, self.max_duration)
+            if len(self.entries) > self.max_users:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(uid)
+        buffer_info['last_seen'] = time.monotonic()
+        buffer_append(buffer_info, audio_bytes)
+        return buffer_info['filled'] / sample_rate
+
+    async def tail(self, uid: str, seconds: float) -> np.ndarray:
+        """Get up to the last seconds of a user's audio as int16 samples"""
+        buffer_info = self.entries[uid]
+        start = buffer_info['total'] - int(seconds * buffer_info['sample_rate'])
+        return buffer_since(buffer_info, start).copy()
+
+    async def claim(self, uid: str) -> bool:
+        """Mark a recognition as running for a user. Returns False if one already is."""
+        buffer_info = self.entries.get(uid)
+        if buffer_info is None or buffer_info.get('recognizing'):
+            return False
+        buffer_info['recognizing'] = True
+        return True
+
+    async def release(self, uid: str):
+        """Mark a user's recognition as finished"""
+        if uid in self.entries:
+            self.entries[uid]['recognizing'] = False
+
+    async def read_new_audio(self, uid: str, overlap: float) -> Optional[tuple]:
+        """
+        Get the audio that hasn't been fingerprinted yet.
+
+        Args:
+            uid: User ID
+            overlap: Seconds of already fingerprinted audio to include before the new audio
+
+        Returns:
+            Tuple of (int16 samples, index of the first sample, sample rate, processed),
+            where processed is the index of the first new sample, or None if the user
+            has no buffer
+        """
+        buffer_info = self.entries.get(uid)
+        if buffer_info is None:
+            return None
+        processed = buffer_info['processed']
+        overlap_samples = int(overlap * buffer_info['sample_rate'])
+        start = max(processed - overlap_samples, buffer_info['total'] - buffer_info['filled'])
+        samples = buffer_since(buffer_info, start).copy()
+        return samples, start, buffer_info['sample_rate'], processed
+
+    async def add_hashes(self, uid: str, new_hashes: list, sample_rate: int, processed: int,
+                         end: int) -> Optional[list]:
+        """
+        Add the hashes for newly fingerprinted audio to a user's buffer.
+
+        Hashes for anchors before processed (the overlap) are skipped, and hashes for
+        audio the buffer has since dropped are forgotten.
+
+        Args:
+            uid: User ID
+            new_hashes: List of (hash, time_offset) tuples for the new audio
+            sample_rate: Sample rate, as returned by read_new_audio
+            processed: processed, as returned by read_new_audio
+            end: Index of the sample after the last one fingerprinted
+
+        Returns:
+            All the (hash, time_offset) tuples for the buffered audio, or None if
+            the buffer was cleared or replaced while fingerprinting (processed,
+            the sample rate or the stream position no longer match)
+        """
+        buffer_info = self.entries.get(uid)
+        if (buffer_info is None or buffer_info['sample_rate'] != sample_rate
+                or buffer_info['processed'] != processed or buffer_info['total'] < end):
+            return None
+
+        oldest = (buffer_info['total'] - buffer_info['filled']) / sample_rate
+        buffer_info['hashes'] = [h for h in buffer_info['hashes'] if h[1] >= oldest]
+        buffer_info['hashes'].extend(h for h in new_hashes if h[1] >= processed / sample_rate)
+        buffer_info['processed'] = end
+        return buffer_info['hashes']
+
+    async def get_fields(self, uid: str, *names) -> dict:
+        """Get extra per-user values, such as last_recognition, stored with set_fields"""
+        buffer_info = self.entries.get(uid, {})
+        return {name: buffer_info.get(name) for name in names}
+
+    async def set_fields(self, uid: str, **values):
+        """Store extra per-user values alongside a user's buffer"""
+        if uid in self.entries:
+            self.entries[uid].update(values)
+
+    async def clear(self, uid: str):
+        """Empty a user's audio and hashes, keeping their other values"""
+        if uid in self.entries:
+            buffer_clear(self.entries[uid])
+
+    async def delete(self, uid: str) -> bool:
+        """Remove a user's buffer entirely. Returns False if there wasn't one."""
+        return self.entries.pop(uid, None) is not None
+
+    async def stats(self, uid: str) -> Optional[dict]:
+        """Get the size, sample rate and last recognition of a user's buffer, or None"""
+        buffer_info = self.entries.get(uid)
+        if buffer_info is None:
+            return None
+        return {
+            'buffer_size_bytes': buffer_info['filled'] * 2,
+            'sample_rate': buffer_info['sample_rate'],
+            'last_recognition': buffer_info.get('last_recognition')
+        }
+
+    async def count(self) -> int:
+        """Number of users with a buffer"""
+        return len(self.entries)
+
+    async def sweep(self) -> int:
+        """
+        Drop the buffers of users who haven't sent audio for ttl seconds.
+
+        Returns:
+            Number of buffers dropped
+        """
+        cutoff = time.monotonic() - self.ttl
+        swept = 0
+        # Least recently used first, so stop at the first user seen since the cutoff
+        while self.entries and next(iter(self.entries.values()))['last_seen'] < cutoff:
+            self.entries.popitem(last=False)
+            swept += 1
+        return swept
+
+    async def close(self):
+        """Nothing to release for in-process buffers"""
+
+
+# Append audio to a user's buffer. Recreates the buffer if the sample rate changed,
+# and once the audio is twice the buffer's capacity cuts it back to capacity, so the
+# copy is amortized over many appends. Also records when the user was last seen.
+# KEYS: audio, user, hashes, active users. ARGV: audio bytes, sample rate, capacity
+# in bytes, TTL, uid, current time. Returns the audio's length in bytes.
+APPEND_SCRIPT = """
+local rate = redis.call('HGET', KEYS[2], 'sample_rate')
+if rate and rate ~= ARGV[2] then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+end
+redis.call('HSETNX', KEYS[2], 'processed', 0)
+redis.call('HSET', KEYS[2], 'sample_rate', ARGV[2])
+redis.call('HINCRBY', KEYS[2], 'total', string.len(ARGV[1]))
+local len = redis.call('APPEND', KEYS[1], ARGV[1])
+local cap = tonumber(ARGV[3])
+if len > 2 * cap then
+    redis.call('SET', KEYS[1], redis.call('GETRANGE', KEYS[1], len - cap, -1))
+    len = cap
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+redis.call('ZADD', KEYS[4], ARGV[6], ARGV[5])
+return len
+"""
+
+# Read whole samples of a user's audio from an absolute byte offset (or, if ARGV[3]
+# is positive, the last ARGV[3] bytes) to the end of the buffer.
+# KEYS: audio, user. ARGV: start offset, capacity in bytes, tail length in bytes.
+# Returns the offset actually read from and the bytes.
+READ_SCRIPT = """
+local total = tonumber(redis.call('HGET', KEYS[2], 'total') or '0')
+local len = redis.call('STRLEN', KEYS[1])
+local physical = total - len
+local start = tonumber(ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+    start = total - tonumber(ARGV[3])
+end
+start = math.max(start, total - math.min(len, tonumber(ARGV[2])))
+start = start + start % 2
+local stop = total - total % 2
+if start >= stop then
+    return {start, ''}
+end
+return {start, redis.call('GETRANGE', KEYS[1], start - physical, stop - physical - 1)}
+"""
+
+# Store a user's hashes and how far they go, unless the buffer was cleared or
+# replaced since they were read: the sample rate, processed sample and hashes'
+# length must be as read, and the stream must still reach the end sample.
+# KEYS: user, hashes. ARGV: sample rate, processed, end sample, length of the
+# hashes as read, packed hashes, TTL. Returns 1 if stored, 0 if not.
+HASHES_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'sample_rate', 'processed', 'total')
+if state[1] ~= ARGV[1] or state[2] ~= ARGV[2] or tonumber(state[3]) < 2 * tonumber(ARGV[3])
+        or redis.call('STRLEN', KEYS[2]) ~= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[5], 'EX', ARGV[6])
+redis.call('HSET', KEYS[1], 'processed', ARGV[3])
+return 1
+"""
+
+
+class RedisBufferStorage:
+    """
+    Audio buffers held in Redis, shared by every worker and instance.
+
+    Per user there is an audio string (raw PCM, appended to), a hash of counters and
+    values (sample rate, total bytes received, processed samples, last_recognition...),
+    a string of packed fingerprint hashes (HASH_DTYPE) and a lock key held while a
+    recognition runs. All of them expire after ttl seconds without new audio.
+    A sorted set of user IDs by the time they last sent audio (ACTIVE_KEY) is
+    kept so users can be counted without scanning keys; sweep prunes it.
+    """
+
+    # Sorted set of user IDs, scored by when they last sent audio
+    ACTIVE_KEY = "omi:active"
+
+    def __init__(self, url: str, max_duration: int, ttl: int = 120):
+        """
+        Args:
+            url: Redis URL, e.g. redis://localhost:6379/0
+            max_duration: Seconds of audio to keep per user
+            ttl: Seconds without audio after which a user's buffer expires
+        """
+        self.client = redis.from_url(url)
+        self.max_duration = max_duration
+        self.ttl = ttl
+        self.append_script = self.client.register_script(APPEND_SCRIPT)
+        self.read_script = self.client.register_script(READ_SCRIPT)
+        self.hashes_script = self.client.register_script(HASHES_SCRIPT)
+
+    @staticmethod
+    def keys(uid: str) -> tuple:
+        """Redis keys of a user's audio, values, hashes and lock"""
+        return (f"omi:audio:{uid}", f"omi:user:{uid}", f"omi:hashes:{uid}", f"omi:lock:{uid}")
+
+    async def read(self, uid: str, start: int = 0, tail: int = 0) -> tuple:
+        """Run READ_SCRIPT, returning (index of the first sample, int16 samples)"""
+        audio_key, user_key, _, _ = self.keys(uid)
+        sample_rate = int(await self.client.hget(user_key, 'sample_rate') or 0)
+        first, data = await self.read_script(
+            keys=[audio_key, user_key],
+            args=[start * 2, self.max_duration * sample_rate * 2, tail * 2]
+        )
+        return int(first) // 2, np.frombuffer(data, dtype=np.int16)
+
+    async def append(self, uid: str, sample_rate: int, audio_bytes: bytes) -> float:
+        """
+        Append audio to a user's buffer, creating it (or replacing it if the sample rate changed).
+
+        Returns:
+            Seconds of audio now buffered
+        """
+        audio_key, user_key, hashes_key, _ = self.keys(uid)
+        capacity = self.max_duration * sample_rate * 2
+        length = await self.append_script(
+            keys=[audio_key, user_key, hashes_key, self.ACTIVE_KEY],
+            args=[audio_bytes, sample_rate, capacity, self.ttl, uid, time.time()]
+        )
+        return min(length, capacity) // 2 / sample_rate
+
+    async def tail(self, uid: str, seconds: float) -> np.ndarray:
+        """Get up to the last seconds of a user's audio as int16 samples"""
+        sample_rate = int(await self.client.hget(self.keys(uid)[1], 'sample_rate') or 0)
+        _, samples = await self.read(uid, tail=int(seconds * sample_rate))
+        return samples
+
+    async def claim(self, uid: str) -> bool:
+        """Mark a recognition as running for a user. Returns False if one already is."""
+        return bool(await self.client.set(self.keys(uid)[3], time.time(), nx=True, ex=self.ttl))
+
+    async def release(self, uid: str):
+        """Mark a user's recognition as finished"""
+        await self.client.delete(self.keys(uid)[3])
+
+    async def read_new_audio(self, uid: str, overlap: float) -> Optional[tuple]:
+        """
+        Get the audio that hasn't been fingerprinted yet.
+
+        Args:
+            uid: User ID
+            overlap: Seconds of already fingerprinted audio to include before the new audio
+
+        Returns:
+            Tuple of (int16 samples, index of the first sample, sample rate, processed),
+            where processed is the index of the first new sample, or None if the user
+            has no buffer
+        """
+        sample_rate, processed = await self.client.hmget(self.keys(uid)[1], 'sample_rate', 'processed')
+        if sample_rate is None:
+            return None
+        processed = int(processed)
+        overlap_samples = int(overlap * int(sample_rate))
+        start, samples = await self.read(uid, start=max(processed - overlap_samples, 0))
+        return samples, start, int(sample_rate), processed
+
+    async def add_hashes(self, uid: str, new_hashes: list, sample_rate: int, processed: int,
+                         end: int) -> Optional[list]:
+        """
+        Add the hashes for newly fingerprinted audio to a user's buffer.
+
+        Hashes for anchors before processed (the overlap) are skipped, and hashes for
+        audio the buffer has since dropped are forgotten.
+
+        Args:
+            uid: User ID
+            new_hashes: List of (hash, time_offset) tuples for the new audio
+            sample_rate: Sample rate, as returned by read_new_audio
+            processed: processed, as returned by read_new_audio
+            end: Index of the sample after the last one fingerprinted
+
+        Returns:
+            All the (hash, time_offset) tuples for the buffered audio, or None if
+            the buffer was cleared or replaced while fingerprinting (processed,
+            the sample rate or the stream position no longer match)
+        """
+        audio_key, user_key, hashes_key, _ = self.keys(uid)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hget(user_key, 'total')
+            pipe.strlen(audio_key)
+            pipe.get(hashes_key)
+            total, length, packed = await pipe.execute()
+
+        filled = min(length, self.max_duration * sample_rate * 2) // 2
+        oldest = (int(total or 0) // 2 - filled) / sample_rate
+
+        hashes = np.frombuffer(packed or b'', dtype=HASH_DTYPE)
+        new = np.array(new_hashes, dtype=HASH_DTYPE)
+        hashes = np.concatenate((
+            hashes[hashes['offset'] >= oldest],
+            new[new['offset'] >= processed / sample_rate]
+        ))
+
+        stored = await self.hashes_script(
+            keys=[user_key, hashes_key],
+            args=[sample_rate, processed, end, len(packed or b''), hashes.tobytes(), self.ttl]
+        )
+        if not stored:
+            return None
+        return hashes.tolist()
+
+    async def get_fields(self, uid: str, *names) -> dict:
+        """Get extra per-user values, such as last_recognition, stored with set_fields"""
+        values = await self.client.hmget(self.keys(uid)[1], *names)
+        return {name: json.loads(value) if value is not None else None for name, value in zip(names, values)}
+
+    async def set_fields(self, uid: str, **values):
+        """Store extra per-user values alongside a user's buffer"""
+        user_key = self.keys(uid)[1]
+        if await self.client.exists(user_key):
+            await self.client.hset(user_key, mapping={name: json.dumps(value) for name, value in values.items()})
+
+    async def clear(self, uid: str):
+        """Empty a user's audio and hashes, keeping their other values"""
+        audio_key, user_key, hashes_key, _ = self.keys(uid)
+        total = int(await self.client.hget(user_key, 'total') or 0)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(audio_key, hashes_key)
+            pipe.hset(user_key, 'processed', total // 2)
+            await pipe.execute()
+
+    async def delete(self, uid: str) -> bool:
+        """Remove a user's buffer entirely. Returns False if there wasn't one."""
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(*self.keys(uid))
+            pipe.zrem(self.ACTIVE_KEY, uid)
+            deleted, _ = await pipe.execute()
+        return deleted > 0
+
+    async def stats(self, uid: str) -> Optional[dict]:
+        """Get the size, sample rate and last recognition of a user's buffer, or None"""
+        audio_key, user_key, _, _ = self.keys(uid)
+        sample_rate, last_recognition = await self.client.hmget(user_key, 'sample_rate', 'last_recognition')
+        if sample_rate is None:
+            return None
+        sample_rate = int(sample_rate)
+        length = await self.client.strlen(audio_key)
+        return {
+            'buffer_size_bytes': min(length, self.max_duration * sample_rate * 2),
+            'sample_rate': sample_rate,
+            'last_recognition': json.loads(last_recognition) if last_recognition else None
+        }
+
+    async def count(self) -> int:
+        """Number of users with a buffer, i.e. who sent audio in the last ttl seconds"""
+        return await self.client.zcount(self.ACTIVE_KEY, time.time() - self.ttl, '+inf')
+
+    async def sweep(self) -> int:
+        """
+        Forget users whose buffers Redis has expired, so ACTIVE_KEY doesn't grow.
+
+        Returns:
+            Number of users forgotten
+        """
+        return await self.client.zremrangebyscore(self.ACTIVE_KEY, '-inf', time.time() - self.ttl)
+
+    async def close(self):
+        """Close the connection pool"""
+        await self.client.aclose()
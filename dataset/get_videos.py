@@ -1,133 +1,287 @@
+import argparse
 import pandas as pd
-import subprocess
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import Lock
 import os
-import sys
 import threading
+import time
+from yt_dlp.utils import DownloadError
+from scraper import download_one
+from abracadabra.storage import setup_db, song_in_db
+from abracadabra.fingerprint import file_to_audio
+import abracadabra.recognise as recog
+from abracadabra.utils import available_cpu_count
 
-# Global lock for file writing
-file_lock = threading.Lock()
+try:
+    import pyarrow.csv
+    import pyarrow.parquet
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 
-def get_track_names_from_csv(csv_filepath):
+DOWNLOAD_ATTEMPTS = 3
+"""Times to try a track's download before giving up on it. Attempts back off exponentially."""
+
+DECODE_TIMEOUT = 180
+"""Seconds ffmpeg may spend decoding one track before the track is abandoned."""
+
+TRACK_COLUMNS = ['track_name', 'artists', 'album_name', 'popularity']
+"""Columns of the dataset CSV used to build the track list."""
+
+
+def ensure_parquet(csv_filepath):
+    """Converts the CSV file to Parquet next to it, unless an up-to-date copy exists.
+
+    :param csv_filepath: Path to the CSV file.
+    :return: Path to the Parquet file.
+    :rtype: str
+    """
+    parquet_filepath = os.path.splitext(csv_filepath)[0] + '.parquet'
+    if (not os.path.exists(parquet_filepath)
+            or os.path.getmtime(parquet_filepath) < os.path.getmtime(csv_filepath)):
+        print(f"Converting {csv_filepath} to {parquet_filepath}...")
+        # Read empty fields as nulls, as pandas does, so dropna treats both paths alike
+        convert_options = pyarrow.csv.ConvertOptions(strings_can_be_null=True)
+        table = pyarrow.csv.read_csv(csv_filepath, convert_options=convert_options)
+        pyarrow.parquet.write_table(table, parquet_filepath)
+    return parquet_filepath
+
+
+def dedupe_by_popularity(df):
+    """Keeps the most popular row for each track name, ordered by descending popularity.
+
+    Rows without a popularity sort after every row that has one.
+    """
+    df = df.dropna(subset=['track_name'])
+    # stable sort so ties keep file order, whatever the chunk boundaries
+    df = df.sort_values(by='popularity', ascending=False, kind='stable', na_position='last')
+    return df.drop_duplicates(subset='track_name', keep='first')
+
+
+def get_track_names_from_csv(csv_filepath, chunksize=200_000):
     """Parses the CSV file and extracts unique track names along with their metadata.
 
+    When pyarrow is installed the CSV is converted to Parquet once with
+    :func:`ensure_parquet`, and later runs load only the columns needed from that.
+    Otherwise only the columns needed are parsed, and the file is streamed ``chunksize``
+    rows at a time so peak memory scales with the number of unique tracks rather than
+    the size of the CSV. Where a track name appears more than once, the most popular
+    row is kept.
+
     :param csv_filepath: Path to the CSV file.
-    :return: A dictionary where keys are track names and values are dictionaries
-             containing 'artist', 'album_name', and 'track_name'.
-    :rtype: dict
+    :param chunksize: Number of rows to parse at a time when reading the CSV directly.
+    :return: A list of dictionaries containing 'artist', 'album_name', and 'track_name',
+             ordered by descending popularity.
+    :rtype: list(dict)
+    """
+    if PYARROW_AVAILABLE:
+        df = pd.read_parquet(ensure_parquet(csv_filepath), columns=TRACK_COLUMNS)
+        df = dedupe_by_popularity(df)
+    else:
+        reader = pd.read_csv(
+            csv_filepath,
+            usecols=TRACK_COLUMNS,
+            dtype={
+                'track_name': 'string',
+                'artists': 'string',
+                'album_name': 'string',
+                # nullable, as some rows have no popularity
+                'popularity': 'Int32'
+            },
+            engine='c',
+            chunksize=chunksize
+        )
+        # Dedupe each chunk as it arrives so only the best row per track is retained,
+        # then resolve duplicates that span chunks.
+        df = dedupe_by_popularity(pd.concat(dedupe_by_popularity(chunk) for chunk in reader))
+    df = df.rename(columns={'artists': 'artist'}).fillna({
+        'artist': 'Unknown Artist',
+        'album_name': 'Unknown Album'
+    })
+    return df[['artist', 'album_name', 'track_name']].to_dict(orient='records')
+
+
+def init_recognise_worker(l):
+    """Init function for the recognise pool. Shares one lock between the worker
+    processes so that :func:`~abracadabra.recognise.register_song` serialises its
+    SQLite writes, as :func:`~abracadabra.recognise.register_directory` does.
+    """
+    recog.lock = l
+
+
+def register_track(downloaded_filepath, song_info):
+    """Fingerprints and stores a downloaded track. Runs in the recognise pool.
+
+    The audio is decoded by ffmpeg straight into memory, so it is never written
+    out as a WAV file or decoded a second time.
+
+    :param downloaded_filepath: Path of the downloaded audio, in whatever format
+                                YouTube served it.
+    :param song_info: A tuple of form (artist, album, title) describing the track.
+    :returns: Whether the track ended up in the database.
+    :rtype: bool
+    """
+    if not song_in_db(downloaded_filepath):
+        frames = file_to_audio(downloaded_filepath, timeout=DECODE_TIMEOUT)
+        recog.register_audio(frames, downloaded_filepath, song_info)
+    return song_in_db(downloaded_filepath)
+
+
+def search_query(track_metadata):
+    """The YouTube search query for a track. Also the line logged once it's registered."""
+    return track_metadata['track_name'] + " song " + track_metadata["artist"] + " official audio"
+
+
+def load_completed(output_filepath):
+    """Reads the queries of tracks registered by previous runs.
+
+    :param output_filepath: Path of the successful recognitions log.
+    :return: The set of logged queries, empty if the log doesn't exist yet.
+    :rtype: set(str)
     """
-    df = pd.read_csv(csv_filepath)
-    
-    df = df.sort_values(by='popularity', ascending=False)
-    # Drop rows where 'track_name' is NaN before processing
-    df_cleaned = df.dropna(subset=['track_name'])
-    
-    track_metadata = {}
-    for index, row in df_cleaned.iterrows():
-        track_name = row['track_name']
-        track_metadata[track_name] = {
-            'artist': row.get('artists', 'Unknown Artist'),
-            'album_name': row.get('album_name', 'Unknown Album'),
-            'track_name': track_name
-        }
-    return track_metadata
-
-def call_scraper_and_recognise(track_metadata, output_filepath):
-    """Calls scraper.py, then song_recogniser, then deletes the WAV file.
-    Metadata is written to the WAV file after download.
+    if not os.path.exists(output_filepath):
+        return set()
+    with open(output_filepath) as f:
+        return set(f.read().splitlines())
+
+
+def download_with_retries(query):
+    """Calls :func:`scraper.download_one`, retrying failed downloads with exponential backoff.
+
+    yt-dlp already retries individual requests and times out stalled sockets; this
+    covers the rest of the transient failures (throttling, 403 loops, dead mirrors)
+    so one bad track gives up within a bounded time instead of holding its worker.
+    """
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            return download_one(query, convert=False)
+        except DownloadError as e:
+            if attempt == DOWNLOAD_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"Download of {query} failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+def call_scraper_and_recognise(track_metadata, output_fd, recognise_pool):
+    """Downloads a track with the scraper, then registers it with the song recogniser
+    using the track's metadata from the CSV.
+
+    Runs in a network worker thread; the CPU-bound fingerprinting is handed to
+    ``recognise_pool`` so it never contends with the downloads for the GIL.
+    The downloaded audio is deleted once it has been registered.
+    Successful track names are appended to ``output_fd``, which must be opened
+    with ``O_APPEND`` so concurrent single-line writes never interleave.
     """
-    track_name = track_metadata['track_name'] + " song " + track_metadata["artist"] + " official audio"
+    track_name = search_query(track_metadata)
     downloaded_filepath = None
-    python_executable = sys.executable
 
     try:
-        script_path = os.path.join(os.path.dirname(__file__), 'scraper.py')
-        process = subprocess.run(
-            [python_executable, script_path, track_name],
-            check=True, capture_output=True, text=True
-        )
+        downloaded_filepath = download_with_retries(track_name)
         print(f"Successfully scraped: {track_name}")
 
-        for line in process.stdout.splitlines():
-            if line.startswith("DOWNLOADED_FILE_PATH:"):
-                downloaded_filepath = line.split(": ", 1)[1].strip()
-                break
-
         if downloaded_filepath and os.path.exists(downloaded_filepath):
-            # Write metadata to the MP3 file
-            from mutagen.mp3 import MP3
-            from mutagen.id3 import ID3, TIT2, TPE1, TALB
-            try:
-                audio = MP3(downloaded_filepath)
-                # MP3 files natively support ID3.
-                if audio.tags is None:
-                    audio.tags = ID3()
-                
-                audio.tags.add(TIT2(encoding=3, text=[track_metadata['track_name']]))
-                audio.tags.add(TPE1(encoding=3, text=[track_metadata['artist']]))
-                audio.tags.add(TALB(encoding=3, text=[track_metadata['album_name']]))
-                audio.tags.save(downloaded_filepath)
-                print(f"Successfully wrote metadata to {downloaded_filepath}")
-            except Exception as e:
-                print(f"Error writing metadata to {downloaded_filepath}: {e}")
-            
+            downloaded_filepath = str(downloaded_filepath)
             print(f"Recognising song: {downloaded_filepath}")
-            recognise_process = subprocess.run(
-                [python_executable, '-m', 'abracadabra.scripts.song_recogniser', 'register', downloaded_filepath],
-                check=True, capture_output=True, text=True
-            )
-            if recognise_process.stdout:
-                print("Recognizer stdout:", recognise_process.stdout)
-            if recognise_process.stderr:
-                print("Recognizer stderr:", recognise_process.stderr)
-            recognition_result = recognise_process.stdout.strip()
-            print(f"Recognition result for {track_name}: {recognition_result}")
+            song_info = (track_metadata['artist'], track_metadata['album_name'], track_metadata['track_name'])
+            registered = recognise_pool.submit(register_track, downloaded_filepath, song_info).result()
 
             # Write successful song title to file
-            if recognition_result and "None" not in recognition_result: # Assuming 'None' means no recognition
-                with file_lock:
-                    with open(output_filepath, 'a') as f:
-                        f.write(f"{track_name}\n")
+            if registered:
+                os.write(output_fd, f"{track_name}\n".encode())
                 print(f"Logged successful recognition for: {track_name}")
+            else:
+                print(f"No fingerprints stored for: {track_name}")
         else:
             print(f"Error: Downloaded file path not found or file does not exist for {track_name}")
 
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f"Error processing {track_name}: {e}")
-        if e.stdout:
-            print("Scraper stdout:", e.stdout)
-        if e.stderr:
-            print("Scraper stderr:", e.stderr)
-    except FileNotFoundError:
-        print(f"Error: Scraper or song_recogniser script not found for {track_name}")
     finally:
-        pass
-        # if downloaded_filepath and os.path.exists(downloaded_filepath):
-        #     try:
-        #         os.remove(downloaded_filepath)
-        #         print(f"Deleted MP3 file: {downloaded_filepath}")
-        #     except OSError as e:
-        #         print(f"Error deleting file {downloaded_filepath}: {e}")
+        # The download lives in scratch space (tmpfs where available) and is only
+        # needed until it has been fingerprinted
+        if downloaded_filepath and os.path.exists(downloaded_filepath):
+            try:
+                os.remove(downloaded_filepath)
+                print(f"Deleted downloaded file: {downloaded_filepath}")
+            except OSError as e:
+                print(f"Error deleting file {downloaded_filepath}: {e}")
+
+def parse_args():
+    cpus = available_cpu_count()
+    p = argparse.ArgumentParser(
+        description="Download, fingerprint and register the tracks listed in the dataset CSV."
+    )
+    p.add_argument("--net-workers", type=int, default=min(32, 4 * cpus),
+                   help="Threads downloading tracks. Default: 4 per available CPU, at most 32.")
+    p.add_argument("--recognise-workers", type=int, default=cpus,
+                   help="Processes fingerprinting tracks. Default: one per available CPU.")
+    return p.parse_args()
+
+
+def process_tracks(track_names_list, output_fd, net_workers, recognise_workers):
+    """Downloads and registers every track, ``net_workers`` downloads and
+    ``recognise_workers`` fingerprint jobs at a time.
+
+    Downloads are network-bound and fingerprinting is CPU-bound, so each stage
+    gets its own pool: plenty of threads for yt-dlp, one process per core for
+    the FFTs. A network thread waits on its track's fingerprint job, which
+    bounds the number of downloaded-but-unprocessed files to ``net_workers``.
+
+    :param track_names_list: Track metadata, as returned by :func:`get_track_names_from_csv`.
+    :param output_fd: Descriptor of the successful recognitions log, opened with ``O_APPEND``.
+    :param net_workers: Threads downloading tracks.
+    :param recognise_workers: Processes fingerprinting tracks.
+    """
+    # The recognise pool is entered first so it shuts down last: leaving the
+    # net pool's block waits for every download, and those still hand their
+    # tracks to the recognise pool
+    with ProcessPoolExecutor(max_workers=recognise_workers,
+                             initializer=init_recognise_worker,
+                             initargs=(Lock(),)) as recognise_pool, \
+            ThreadPoolExecutor(max_workers=net_workers) as net_pool:
+        # Only keep a couple of tracks queued per download thread, instead of
+        # handing the executor every track up front
+        in_flight = threading.BoundedSemaphore(2 * net_workers)
+
+        def on_done(future):
+            in_flight.release()
+            if future.exception() is not None:
+                print(f"Worker failed: {future.exception()}")
+
+        for metadata in track_names_list:
+            in_flight.acquire()
+            future = net_pool.submit(call_scraper_and_recognise, metadata, output_fd, recognise_pool)
+            future.add_done_callback(on_done)
+
 
 def main():
+    args = parse_args()
     csv_filepath = './archive/dataset.csv' # Assuming this path relative to the project root
     output_filename = 'successful_recognitions.txt'
     output_filepath = os.path.join(os.path.dirname(__file__), output_filename)
 
     # Initialize the song recogniser database
     print("Initializing song recogniser database...")
-    python_executable = sys.executable
-    script_path = os.path.join(os.path.dirname(__file__), '..', 'abracadabra', 'scripts', 'song_recogniser.py')
-    subprocess.run([python_executable, script_path, 'initialise'], check=True)
+    setup_db()
     print("Song recogniser database initialized.")
 
-    all_track_metadata = get_track_names_from_csv(csv_filepath)
-    track_names_list = list(all_track_metadata.values())
+    track_names_list = get_track_names_from_csv(csv_filepath)
+
+    # Don't download tracks again that a previous run already registered
+    completed = load_completed(output_filepath)
+    if completed:
+        track_count = len(track_names_list)
+        track_names_list = [m for m in track_names_list if search_query(m) not in completed]
+        print(f"Skipping {track_count - len(track_names_list)} tracks registered by previous runs.")
 
-    with ThreadPoolExecutor(max_workers=os.cpu_count() * 2) as executor:
-        # Pass output_filepath to the concurrent function
-        executor.map(lambda metadata: call_scraper_and_recognise(metadata, output_filepath), track_names_list)
+    # O_APPEND makes each write land atomically at the end of the file, so the
+    # workers can share one descriptor without a lock
+    output_fd = os.open(output_filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        process_tracks(track_names_list, output_fd, args.net_workers, args.recognise_workers)
+    finally:
+        os.close(output_fd)
 
 if __name__ == "__main__":
     main() # End of script
-
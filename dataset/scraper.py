@@ -4,20 +4,38 @@ Find the first YouTube search result for a query (no API key), download it,
 and convert the audio to a WAV file using yt-dlp + ffmpeg.
 
 Usage examples:
-  python yt_first_to_wav.py "lofi hip hop"
-  python yt_first_to_wav.py "bach cello suite 1" --outdir out --ar 16000 --ac 1
-  python yt_first_to_wav.py "creative commons birdsong" --ffmpeg "C:\\ffmpeg\\bin\\ffmpeg.exe"
+  python scraper.py "lofi hip hop"
+  python scraper.py "bach cello suite 1" --outdir out --ar 16000 --ac 1
+  python scraper.py "creative commons birdsong" --ffmpeg "C:\\ffmpeg\\bin\\ffmpeg.exe"
+
+The only thing written to stdout is a single line of JSON, ``{"path": "<wav path>"}``
+(``{"path": null}`` if nothing was found), so callers can ``json.loads`` it directly.
+Progress and yt-dlp's own logging go to stderr.
 
 Notes:
 - Only download videos you have the right to download.
 - Requires: yt-dlp, ffmpeg.
 """
 
+import os
 import sys
+import json
+import tempfile
 import argparse
+import functools
+import shutil
+import threading
 from pathlib import Path
 import yt_dlp
-import os
+
+
+SCRATCH_DIR = os.environ.get("ABRACADABRA_SCRATCH") or (
+    "/dev/shm/abracadabra" if os.path.isdir("/dev/shm")
+    else os.path.join(tempfile.gettempdir(), "abracadabra")
+)
+"""Default output directory. Downloads are usually fingerprinted and deleted straight
+away, so they go to tmpfs (``/dev/shm``) where available and never touch the disk.
+Override with the ``ABRACADABRA_SCRATCH`` environment variable."""
 
 
 def parse_args():
@@ -25,121 +43,171 @@ def parse_args():
         description="Search YouTube for the first result and convert audio to WAV."
     )
     p.add_argument("query", help="Search query string (e.g., 'lofi hip hop').")
-    p.add_argument("--outdir", "-o", default="downloads", help="Output directory.")
+    p.add_argument("--outdir", "-o", default=SCRATCH_DIR,
+                   help=f"Output directory. Default: {SCRATCH_DIR}")
     p.add_argument("--ffmpeg", default=None, help="Path to ffmpeg binary (if not on PATH).")
     p.add_argument("--ar", type=int, default=44100, help="Output WAV sample rate (Hz). Default: 44100.")
     p.add_argument("--ac", type=int, default=2, help="Output WAV channels (1=mono, 2=stereo). Default: 2.")
-    p.add_argument("--quiet", action="store_true", help="Reduce yt-dlp output.")
+    p.add_argument("--verbose", dest="quiet", action="store_false",
+                   help="Show full yt-dlp output. By default it is reduced.")
     return p.parse_args()
 
 
-def main():
-    args = parse_args()
-    outdir = Path(args.outdir).expanduser().resolve()
+@functools.lru_cache(maxsize=None)
+def prepare_outdir(outdir):
+    """Resolve and create an output directory, once per distinct ``outdir``."""
+    outdir = Path(outdir).expanduser().resolve()
     outdir.mkdir(parents=True, exist_ok=True)
+    return outdir
+
+
+class TrackDownloader:
+    """A ``YoutubeDL`` set up for one combination of output options, reused across tracks.
+
+    Building a ``YoutubeDL`` loads every extractor and compiles their regexes, so
+    :func:`download_one` keeps one per thread (see :func:`get_downloader`) rather than
+    constructing one per track.
+    """
+    def __init__(self, outdir, ar, ac, ffmpeg, quiet, convert=True):
+        outdir = prepare_outdir(outdir)
+
+        # yt-dlp options:
+        # - format: bestaudio
+        # - postprocessors: FFmpegExtractAudio to WAV (unless convert is False)
+        # - postprocessor_args: ensure 16-bit PCM, desired sample rate/channels
+        ydl_opts = {
+            "format": "bestaudio/best",
+            "outtmpl": str(outdir / "%(uploader)s - %(title)s - %(id)s.%(ext)s"),
+            "noplaylist": True,
+            "extract_flat": False,  # we want the actual media, not just metadata
+            "quiet": quiet,
+            "logtostderr": True,  # keep stdout free for the caller
+            "postprocessors": [
+                {
+                    "key": "FFmpegExtractAudio",
+                    "preferredcodec": "wav",
+                },
+            ],
+            # Enforce PCM 16-bit + chosen rate/channels.
+            # -threads 0 lets ffmpeg use every core for the conversion.
+            "postprocessor_args": {"extractaudio": ["-threads", "0", "-ar", str(ar), "-ac", str(ac)]},
+            "skip_download": False,
+            "ignoreerrors": False,
+            # Fetch fragmented (DASH/HLS) formats over several connections at once
+            "concurrent_fragment_downloads": 4,
+            # Don't let a dead connection hang a worker; yt-dlp retries it instead
+            "socket_timeout": 30,
+            "retries": 3,
+            "fragment_retries": 3,
+        }
+
+        # aria2c splits plain HTTP downloads into parallel ranged requests too
+        if shutil.which("aria2c"):
+            ydl_opts["external_downloader"] = {"default": "aria2c"}
+            ydl_opts["external_downloader_args"] = {"aria2c": ["-x16", "-s16", "-k1M"]}
+
+        if ffmpeg:
+            ydl_opts["ffmpeg_location"] = ffmpeg
+
+        if not convert:
+            # Keep the audio stream as downloaded; the caller decodes it itself
+            ydl_opts["postprocessors"] = []
+
+        self.ydl = yt_dlp.YoutubeDL(ydl_opts)
+
+
+_local = threading.local()
+
+
+def get_downloader(outdir, ar, ac, ffmpeg, quiet, convert=True):
+    """Returns the calling thread's :class:`TrackDownloader` for these options.
+
+    ``YoutubeDL`` isn't safe to share between threads, so each thread gets its own,
+    created the first time that thread downloads with these options.
+    """
+    downloaders = getattr(_local, "downloaders", None)
+    if downloaders is None:
+        downloaders = _local.downloaders = {}
+    key = (outdir, ar, ac, ffmpeg, quiet, convert)
+    if key not in downloaders:
+        downloaders[key] = TrackDownloader(*key)
+    return downloaders[key]
+
+
+def download_one(query, outdir=SCRATCH_DIR, ar=44100, ac=2, ffmpeg=None, quiet=True, convert=True):
+    """Download the first YouTube search result for ``query`` and convert it to WAV.
+
+    :param query: Search query string (e.g., 'lofi hip hop').
+    :param outdir: Output directory. Defaults to :data:`SCRATCH_DIR`.
+    :param ar: Output WAV sample rate (Hz).
+    :param ac: Output WAV channels (1=mono, 2=stereo).
+    :param ffmpeg: Path to ffmpeg binary (if not on PATH).
+    :param quiet: Reduce yt-dlp output.
+    :param convert: Convert the audio to WAV. When False the best audio stream is kept as
+                    downloaded (e.g. webm/m4a) and ``ar`` and ``ac`` are
+                    ignored, for callers that decode it straight to PCM themselves.
+    :returns: Path of the converted WAV file (or the downloaded audio if ``convert`` is
+              False), or None if the search found nothing.
+    :rtype: pathlib.Path
+    """
+    downloader = get_downloader(outdir, ar, ac, ffmpeg, quiet, convert)
 
     # Build the yt-dlp search URL to fetch exactly one result
-    search_url = f"ytsearch1:{args.query}"
-
-    # yt-dlp options:
-    # - format: bestaudio
-    # - postprocessors: FFmpegExtractAudio to WAV
-    # - postprocessor_args: ensure 16-bit PCM, desired sample rate/channels
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": str(outdir / "%(uploader)s - %(title)s - %(id)s.%(ext)s"),
-        "noplaylist": True,
-        "extract_flat": False,  # we want the actual media, not just metadata
-        "quiet": args.quiet,
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "wav",
-            }
-        ],
-        # Enforce PCM 16-bit + chosen rate/channels
-        "postprocessor_args": [],
-        "skip_download": False,
-        "ignoreerrors": False,
-        "n_threads": 1,  # safer for first-result single download
-    }
-
-    if args.ffmpeg:
-        ydl_opts["ffmpeg_location"] = args.ffmpeg
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        # First peek at the result without downloading, so we can show details
-        info = ydl.extract_info(search_url, download=False)
-        if not info:
-            print("No results found for query.")
-            sys.exit(2)
-
-        # When using ytsearch1:, yt-dlp returns a playlist-like dict with one entry
-        entry = None
-        if "entries" in info and info["entries"]:
-            entry = info["entries"][0]
-        else:
-            # Some yt-dlp versions may return a single video dict directly
-            entry = info
-
-        if not entry:
-            print("No valid entry found.")
-            sys.exit(2)
-
-        title = entry.get("title")
-        channel = entry.get("uploader") or entry.get("channel")
-        video_url = entry.get("webpage_url") or (f'https://www.youtube.com/watch?v={entry.get("id")}')
-        duration = entry.get("duration")
-
-        print("=" * 80)
-        print("First result")
-        print("Title   :", title)
-        print("Channel :", channel)
-        print("URL     :", video_url)
-        print("Duration:", f"{duration}s" if duration is not None else "(unknown)")
-        print("=" * 80)
-        print("Starting download and audio conversion to WAV...")
-
-        # Now actually download (this will obey postprocessors to make WAV)
-        # Using the same ytsearch1: URL downloads that first result directly.
-        ydl.download([search_url])
-
-    # Get the actual filename that yt-dlp generated
-    # This part is a bit tricky as yt-dlp doesn't directly return the path
-    # after download in a simple way. We'll rely on the outtmpl to reconstruct.
-    # This might need refinement if the naming convention changes often.
-    # Assuming the outtmpl is `outdir / "%(uploader)s - %(title)s - %(id)s.%(ext)s"`
-    # We need to get the exact `uploader`, `title`, `id` and `ext` used.
-    # A more robust solution might involve parsing yt-dlp's output or using a custom hook.
-
-    # For now, let's assume the first entry's info is used for the filename.
-    # This is a simplification and might break if yt-dlp changes its behavior.
-    # It's better to get the actual downloaded file path.
-    # A better way would be to get the info from the downloaded file directly if possible
-    # Or, if yt-dlp provides a way to get the final filename, use that.
-
-    # Reconstructing the filename based on the info extracted earlier.
-    # This is not ideal as it's a re-computation, not retrieval of actual path.
-    # A more robust solution involves custom hooks in yt-dlp or parsing stdout/stderr of yt-dlp.
-    # For simplicity for now, let's assume the format is consistent.
-    # The actual extension will be 'wav' due to postprocessors.
-    if entry and title and channel and entry.get("id"):
-        # Ensure we use a clean title and channel name for filename reconstruction
-        # yt-dlp might sanitize these further, so this is still an approximation
-        sanitized_title = title.replace(os.path.sep, '_').replace(':', '_').replace('?', '')
-        sanitized_channel = channel.replace(os.path.sep, '_').replace(':', '_').replace('?', '')
-        video_id = entry.get("id")
-        expected_filename = f"{sanitized_channel} - {sanitized_title} - {video_id}.wav"
-        downloaded_filepath = outdir / expected_filename
-
-        # It's possible that yt-dlp changes the filename if there are conflicts,
-        # or if the title contains characters not allowed in filenames. For robustness,
-        # one might need to list files in `outdir` and find the most recently created `.wav` file.
-        # However, for this exercise, we will assume a direct reconstruction is sufficient.
-
-        print(f"DOWNLOADED_FILE_PATH: {downloaded_filepath}")
-
-    print("\nDone. Files saved in:", outdir)
+    search_url = f"ytsearch1:{query}"
+
+    # Search, download and convert in one pass (this will obey postprocessors
+    # to make WAV); the returned info describes the result that was downloaded.
+    print("Searching, then downloading audio...", file=sys.stderr)
+    info = downloader.ydl.extract_info(search_url, download=True)
+    if not info:
+        print("No results found for query.", file=sys.stderr)
+        return None
+
+    # When using ytsearch1:, yt-dlp returns a playlist-like dict with one entry
+    entry = None
+    if "entries" in info and info["entries"]:
+        entry = info["entries"][0]
+    else:
+        # Some yt-dlp versions may return a single video dict directly
+        entry = info
+
+    if not entry:
+        print("No valid entry found.", file=sys.stderr)
+        return None
+
+    title = entry.get("title")
+    channel = entry.get("uploader") or entry.get("channel")
+    video_url = entry.get("webpage_url") or (f'https://www.youtube.com/watch?v={entry.get("id")}')
+    duration = entry.get("duration")
+
+    print("=" * 80, file=sys.stderr)
+    print("First result", file=sys.stderr)
+    print("Title   :", title, file=sys.stderr)
+    print("Channel :", channel, file=sys.stderr)
+    print("URL     :", video_url, file=sys.stderr)
+    print("Duration:", f"{duration}s" if duration is not None else "(unknown)", file=sys.stderr)
+    print("=" * 80, file=sys.stderr)
+
+    # yt-dlp records where each requested download ended up after postprocessing,
+    # whatever its sanitized name ended up as
+    downloads = entry.get("requested_downloads") or []
+    if downloads and downloads[-1].get("filepath"):
+        return Path(downloads[-1]["filepath"])
+    # Older yt-dlp versions: let yt-dlp apply its own output template
+    downloaded_filepath = Path(downloader.ydl.prepare_filename(entry))
+    return downloaded_filepath.with_suffix(".wav") if convert else downloaded_filepath
+
+
+def main():
+    args = parse_args()
+    downloaded_filepath = download_one(
+        args.query, outdir=args.outdir, ar=args.ar, ac=args.ac,
+        ffmpeg=args.ffmpeg, quiet=args.quiet
+    )
+    json.dump({"path": str(downloaded_filepath) if downloaded_filepath else None}, sys.stdout)
+    sys.stdout.write("\n")
+    if downloaded_filepath is None:
+        sys.exit(2)
 
 
 if __name__ == "__main__":
@@ -5,17 +5,19 @@ Receives real-time audio bytes from Omi wearable and recognizes songs
 """
 
 from fastapi import FastAPI, Request, Query, Header, UploadFile, File, Form
-from fastapi.responses import JSONResponse
-import subprocess
+from fastapi.responses import JSONResponse, Response
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import bisect
+import functools
 import tempfile
 import os
-import struct
-import wave
-from datetime import datetime
+import time
 from pathlib import Path
 import logging
 import httpx
-import requests
+import numpy as np
+from scipy.signal import welch
 from typing import Optional
 
 # Load environment variables
@@ -36,15 +38,84 @@ OMI_APP_ID = os.getenv("OMI_APP_ID")
 OMI_API_KEY = os.getenv("OMI_API_KEY")
 OMI_API_BASE_URL = "https://api.omi.me/v1"  # Update if different
 
-# Store audio buffers per user session
-audio_buffers = {}
+# Audio buffers per user session, created on startup: in Redis if REDIS_URL is
+# set, otherwise in this process (see buffer_storage)
+audio_buffers = None
+
+# Running recognition tasks, referenced here so they aren't garbage collected
+recognition_tasks = set()
+
+# Task that periodically drops idle buffers, started on startup
+sweeper_task = None
+
+# Process pool that fingerprints incoming audio, created on startup. Fingerprinting
+# is CPU-bound, so running it in the handler would block the event loop for everyone.
+recognition_executor = None
+
+# Shared client for the Omi notification API, created on startup so connections
+# are reused across notifications
+notify_client = None
+
+# Last /songs response body, as (monotonic time fetched, JSON bytes). Cleared
+# when a song is registered through this process.
+songs_cache = None
 
 # Minimum audio length for recognition (seconds)
 MIN_AUDIO_LENGTH = int(os.getenv("MIN_AUDIO_LENGTH", "10"))
 
-# Maximum buffer duration before trimming (seconds)
+# Maximum buffer duration; older audio is overwritten (seconds)
 MAX_BUFFER_DURATION = int(os.getenv("MAX_BUFFER_DURATION", "60"))
 
+# Length of the most recent audio whose hashes are matched against Supabase (seconds)
+RECOGNITION_WINDOW = MIN_AUDIO_LENGTH + 2
+
+# Redis URL for buffers shared between workers and instances (optional)
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Seconds without audio after which a user's buffer is dropped
+BUFFER_TTL = int(os.getenv("BUFFER_TTL", "120"))
+
+# Most users to keep buffers for in this process (without Redis)
+MAX_ACTIVE_USERS = int(os.getenv("MAX_ACTIVE_USERS", "1000"))
+
+# How often idle buffers are swept (seconds)
+SWEEP_INTERVAL = 30
+
+# Length of the most recent audio checked for music before recognizing (seconds)
+ACTIVITY_WINDOW = 3
+
+# RMS level (16-bit sample units) below which the recent audio counts as silence
+SILENCE_RMS = float(os.getenv("SILENCE_RMS", "200"))
+
+# Spectral flatness above which the recent audio counts as noise rather than music
+NOISE_FLATNESS = float(os.getenv("NOISE_FLATNESS", "0.4"))
+
+# Number of songs whose fingerprints are kept in memory for the still-playing check
+SONG_HASH_CACHE_SIZE = 32
+
+# How far recent hashes may stray from where the last song lined up (seconds)
+ALIGNMENT_TOLERANCE = 0.5
+
+# Seconds without music after which the last recognized song is forgotten
+MATCH_CACHE_SILENCE = 30
+
+# Minimum seconds between the starts of two recognitions for the same user
+RECOGNITION_INTERVAL = float(os.getenv("RECOGNITION_INTERVAL", "5"))
+
+# Seconds a fetched song list is served by /songs before it's fetched again;
+# songs registered through other workers show up within this time
+SONGS_CACHE_TTL = 30
+
+# Bytes copied per read when saving a /register upload to disk
+UPLOAD_CHUNK_SIZE = 1 << 16
+
+# Start of the name a /register upload with an artist and title is fingerprinted
+# under. Uploads used to be renamed to this in /tmp, so the song_ids stay the same
+REGISTER_NAME_PREFIX = "/tmp/1__"
+
+# Number of uvicorn worker processes, each with its own recognition pool
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
 # Path to abracadabra installation
 ABRACADABRA_PATH = os.getenv("ABRACADABRA_PATH", "/Users/anvayvats/abracadabra")
 
@@ -52,6 +123,7 @@ ABRACADABRA_PATH = os.getenv("ABRACADABRA_PATH", "/Users/anvayvats/abracadabra")
 import sys
 sys.path.insert(0, ABRACADABRA_PATH)
 import supabase_storage
+import buffer_storage
 
 # Validate credentials on startup
 if not OMI_APP_ID or not OMI_API_KEY:
@@ -70,9 +142,34 @@ else:
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize Supabase tables on startup"""
+    """Initialize Supabase tables, buffer storage, the recognition pool and the notification client on startup"""
+    global audio_buffers, recognition_executor, notify_client, sweeper_task
+    from abracadabra.utils import available_cpu_count
+
     logger.info("🚀 Starting Omi Song Recognition Webhook...")
 
+    if REDIS_URL and buffer_storage.REDIS_AVAILABLE:
+        audio_buffers = buffer_storage.RedisBufferStorage(REDIS_URL, MAX_BUFFER_DURATION, BUFFER_TTL)
+        logger.info("✅ Audio buffers shared through Redis")
+    else:
+        if REDIS_URL:
+            logger.error("❌ REDIS_URL is set but the redis package is not installed")
+        audio_buffers = buffer_storage.LocalBufferStorage(MAX_BUFFER_DURATION, BUFFER_TTL, MAX_ACTIVE_USERS)
+        logger.info("Audio buffers kept in this process")
+    sweeper_task = asyncio.create_task(sweep_buffers())
+
+    # Every uvicorn worker has a pool, so they share the CPUs between them
+    recognition_workers = max(1, available_cpu_count() // WEB_CONCURRENCY)
+    recognition_executor = ProcessPoolExecutor(max_workers=recognition_workers)
+    logger.info(f"Recognition pool started with {recognition_workers} workers")
+
+    notify_client = httpx.AsyncClient(
+        timeout=10,
+        # HTTP/2 when the h2 package is installed, as for Supabase
+        http2=supabase_storage.HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=100)
+    )
+
     if supabase_storage.supabase:
         logger.info("📝 Initializing Supabase tables...")
         logger.info("If tables don't exist, run this SQL in Supabase SQL Editor:")
@@ -81,64 +178,89 @@ async def startup_event():
         logger.warning("⚠️  Supabase not configured - storage will not work!")
 
 
-def create_wav_file(audio_bytes: bytes, sample_rate: int, output_path: str):
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the recognition pool and close the notification client and buffer storage"""
+    if sweeper_task:
+        sweeper_task.cancel()
+
+    if audio_buffers:
+        await audio_buffers.close()
+
+    if recognition_executor:
+        recognition_executor.shutdown(wait=False, cancel_futures=True)
+
+    if notify_client:
+        await notify_client.aclose()
+
+
+async def sweep_buffers():
+    """Drop the buffers of users who have stopped streaming, every SWEEP_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            swept = await audio_buffers.sweep()
+            if swept:
+                logger.info(f"Dropped {swept} idle audio buffers")
+        except Exception as e:
+            logger.error(f"Error sweeping audio buffers: {e}", exc_info=True)
+
+
+def is_musiclike(pcm: np.ndarray, sample_rate: int) -> bool:
     """
-    Convert raw audio bytes to WAV file format.
+    Cheaply check whether audio could be music worth fingerprinting.
+
+    Audio is rejected if it is quiet (RMS below SILENCE_RMS) or noise-like
+    (spectral flatness above NOISE_FLATNESS).
 
     Args:
-        audio_bytes: Raw PCM audio data
-        sample_rate: Sample rate in Hz (16000 for DevKit1 v1.0.4+/DevKit2, 8000 for v1.0.2)
-        output_path: Path to save the WAV file
+        pcm: 16-bit audio samples
+        sample_rate: Sample rate in Hz
+
+    Returns:
+        True if the audio should be sent for recognition
     """
-    num_channels = 1  # Mono audio
-    sample_width = 2  # 16-bit audio (2 bytes per sample)
+    if len(pcm) == 0:
+        return False
 
-    with wave.open(output_path, 'wb') as wav_file:
-        wav_file.setnchannels(num_channels)
-        wav_file.setsampwidth(sample_width)
-        wav_file.setframerate(sample_rate)
-        wav_file.writeframes(audio_bytes)
+    samples = pcm.astype(np.float64)
+    rms = np.sqrt(np.mean(samples ** 2))
+    if rms < SILENCE_RMS:
+        return False
 
-    logger.info(f"Created WAV file: {output_path} ({len(audio_bytes)} bytes, {sample_rate} Hz)")
+    _, psd = welch(samples, fs=sample_rate, nperseg=min(1024, len(samples)))
+    psd = psd[psd > 0]
+    flatness = np.exp(np.mean(np.log(psd))) / np.mean(psd)
+    return flatness <= NOISE_FLATNESS
 
 
-def recognize_song(audio_file: str) -> dict:
+def recognize_song(sample_fingerprint: list) -> dict:
     """
     Use abracadabra to recognize the song.
 
-    Uses abracadabra fingerprinting with Supabase storage backend.
+    Matches abracadabra fingerprints against the Supabase storage backend.
 
     Args:
-        audio_file: Path to audio file
+        sample_fingerprint: List of (hash, time_offset) tuples for the sample
 
     Returns:
-        dict with keys: artist, album, title, confidence, score
+        dict with keys: song_id, artist, album, title, confidence, score
     """
     try:
-        # Import abracadabra fingerprinting module
-        from abracadabra import fingerprint
-
-        # Generate fingerprint for the audio file
-        logger.info(f"Generating fingerprint for: {audio_file}")
-        sample_fingerprint = fingerprint.fingerprint_file(audio_file)
-
-        if not sample_fingerprint or len(sample_fingerprint) == 0:
-            logger.error("Failed to generate fingerprint")
+        if not sample_fingerprint:
+            logger.error("No fingerprints to match")
             return None
 
-        # Match against Supabase database
+        # Match and score against Supabase database
         logger.info(f"Matching {len(sample_fingerprint)} fingerprints against Supabase")
-        matches = supabase_storage.get_matches_supabase(sample_fingerprint)
+        matches = supabase_storage.match_fingerprints_supabase(sample_fingerprint)
 
         if not matches:
             logger.info("No matches found in database")
             return None
 
         # Get best match
-        from collections import Counter
-        song_counts = Counter(matches)
-        best_match = song_counts.most_common(1)[0]
-        song_id, score = best_match
+        song_id, score = matches[0]
 
         logger.info(f"Best match: song_id={song_id}, score={score}")
 
@@ -151,11 +273,12 @@ def recognize_song(audio_file: str) -> dict:
             return None
 
         artist, album, title = song_info
-        confidence = calculate_confidence(score)
+        confidence = calculate_confidence(score, len(sample_fingerprint))
         
         logger.info(f"✅ Song identified: {artist} - {title} (confidence: {confidence:.0%}, score: {score})")
 
         return {
+            'song_id': song_id,
             'artist': artist if artist != 'Unknown' else None,
             'album': album if album != 'Unknown' else None,
             'title': title if title != 'Unknown' else None,
@@ -164,52 +287,45 @@ def recognize_song(audio_file: str) -> dict:
             'recognized': confidence > 0.5
         }
 
-    except ImportError as e:
-        logger.error(f"Failed to import abracadabra modules: {e}")
-        return None
     except Exception as e:
         logger.error(f"Error recognizing song: {e}", exc_info=True)
         return None
 
 
-def parse_score_from_output(output: str) -> int:
-    """
-    Parse confidence score from detailed_recognition.py output.
-    """
-    import re
+# The score counts the sample's hashes in the best song's largest bin of aligned time
+# offsets, so it grows with the length of the sample and shrinks with noise; confidence
+# is based on the match rate, the share of the sample's hashes that score. Upper bounds
+# of the match rate ranges, and the confidence for each range (see calculate_confidence).
+# Calibrated on noisy 12 second 16 kHz samples: true matches score rates of about
+# 0.03-0.1, songs that aren't registered stay under 0.03 and plain noise under 0.005
+CONFIDENCE_THRESHOLDS = [0.015, 0.03, 0.05, 0.1]
+CONFIDENCE_LEVELS = [0.1, 0.4, 0.7, 0.9, 1.0]
 
-    # Look for "Score: XXXX" pattern
-    score_match = re.search(r'Score:\s*(\d+)', output)
-    if score_match:
-        return int(score_match.group(1))
+# Fewest aligned hashes for a match to count, however few hashes the sample has
+MIN_MATCH_SCORE = 10
 
-    return 0
 
-
-def calculate_confidence(score: int) -> float:
+def calculate_confidence(score: int, sample_size: int) -> float:
     """
-    Convert raw score to confidence percentage (0.0 to 1.0).
+    Convert a match score to a confidence (0.0 to 1.0).
+
+    Match rate (score / sample_size) interpretation:
+    - >10%: Very high confidence (100%)
+    - 5-10%: High confidence (90%)
+    - 3-5%: Medium confidence (70%)
+    - 1.5-3%: Low confidence (40%)
+    - <1.5%, or fewer than MIN_MATCH_SCORE aligned hashes: Very low/noise (10%)
 
-    Score interpretation:
-    - >1000: Very high confidence (100%)
-    - 100-1000: High confidence (90%)
-    - 50-100: Medium confidence (70%)
-    - 10-50: Low confidence (40%)
-    - <10: Very low/noise (10%)
+    Args:
+        score: Size of the largest aligned offset bin, from match_fingerprints
+        sample_size: Number of hashes in the sample that was matched
     """
-    if score > 1000:
-        return 1.0
-    elif score > 100:
-        return 0.9
-    elif score > 50:
-        return 0.7
-    elif score > 10:
-        return 0.4
-    else:
-        return 0.1
+    if score < MIN_MATCH_SCORE:
+        return CONFIDENCE_LEVELS[0]
+    return CONFIDENCE_LEVELS[bisect.bisect_left(CONFIDENCE_THRESHOLDS, score / sample_size)]
 
 
-def send_notification_to_user(uid: str, song_info: dict) -> bool:
+async def send_notification_to_user(uid: str, song_info: dict) -> bool:
     """
     Send song recognition result to user via Omi notification API.
 
@@ -228,10 +344,7 @@ def send_notification_to_user(uid: str, song_info: dict) -> bool:
 
     try:
         # Official Omi notification endpoint (query params in URL, empty body)
-        import urllib.parse
-        
-        encoded_message = urllib.parse.quote(message)
-        url = f"https://api.omi.me/v2/integrations/{OMI_APP_ID}/notification?uid={uid}&message={encoded_message}"
+        url = f"https://api.omi.me/v2/integrations/{OMI_APP_ID}/notification"
 
         headers = {
             "Authorization": f"Bearer {OMI_API_KEY}",
@@ -239,16 +352,18 @@ def send_notification_to_user(uid: str, song_info: dict) -> bool:
             "Content-Length": "0"
         }
 
-        response = requests.post(url, headers=headers, timeout=30)
+        response = await notify_client.post(
+            url, headers=headers, params={"uid": uid, "message": message}
+        )
         response.raise_for_status()
 
         logger.info(f"✅ Notification sent successfully to {uid}")
         return True
 
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error(f"❌ Notification timeout for user {uid}")
         return False
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"❌ Error sending notification to {uid}: {str(e)}")
         return False
     except Exception as e:
@@ -277,6 +392,225 @@ def format_notification_message(song_info: dict) -> str:
     return f"{emoji} You're listening to: '{title}' by {artist}{certainty}"
 
 
+def fingerprint_slice(pcm: np.ndarray, sample_rate: int, start_time: float) -> list:
+    """
+    Fingerprint a slice of a user's audio stream.
+
+    Args:
+        pcm: 16-bit audio samples
+        sample_rate: Sample rate in Hz
+        start_time: Time of the first sample in the stream (seconds)
+
+    Returns:
+        List of (hash, time_offset) tuples, with offsets measured from the start of the stream
+    """
+    from abracadabra import fingerprint
+    return [
+        (h, offset + start_time)
+        for h, offset, _ in fingerprint.fingerprint_samples(pcm, sample_rate)
+    ]
+
+
+def upload_song_name(upload_path: str, filename: str, artist: Optional[str], title: Optional[str]) -> str:
+    """
+    Name a /register upload so that registering the same song again keeps its song_id.
+
+    With both artist and title given, the name is the one uploads used to be renamed
+    to (REGISTER_NAME_PREFIX<artist>__<title>.ext), so songs registered that way keep
+    their song_id on any host. Otherwise nothing identifies the song, so it is the
+    upload's own temporary path, and two uploads never share a song_id.
+
+    Args:
+        upload_path: Where the upload was saved
+        filename: Name of the uploaded file
+        artist: Artist given with the upload
+        title: Title given with the upload
+
+    Returns:
+        Name to generate the song_id from
+    """
+    if artist and title:
+        return f"{REGISTER_NAME_PREFIX}{artist.replace(' ', '-')}__{title.replace(' ', '-')}{os.path.splitext(filename)[1]}"
+    return upload_path
+
+
+@functools.lru_cache(maxsize=SONG_HASH_CACHE_SIZE)
+def song_hashes(song_id: str) -> dict:
+    """
+    Get a registered song's fingerprints, cached per song.
+
+    Returns:
+        Dict of each of the song's hashes to the time offsets it occurs at
+
+    Raises:
+        LookupError: If no hashes could be fetched (so the miss isn't cached)
+    """
+    fingerprints = supabase_storage.get_song_hashes_supabase(song_id)
+    if not fingerprints:
+        raise LookupError(f"No hashes found for song {song_id}")
+    offsets = {}
+    for h, offset in fingerprints:
+        offsets.setdefault(h, []).append(offset)
+    return offsets
+
+
+def offset_deltas(known: dict, fingerprints: list) -> np.ndarray:
+    """
+    Get the time offset deltas of the hashes that fingerprints share with a song.
+
+    Args:
+        known: The song's hashes, as returned by song_hashes
+        fingerprints: (hash, time_offset) tuples of the user's audio
+
+    Returns:
+        Array of time_offset minus song offset, one per occurrence in the song
+    """
+    return np.array([offset - song_offset for h, offset in fingerprints for song_offset in known.get(h, ())])
+
+
+def song_alignment(song_id: str, fingerprints: list) -> Optional[float]:
+    """
+    Find where a recognized song lines up with the user's audio.
+
+    Buffer time offsets run on across clears, so while the song keeps playing its
+    hashes keep turning up at the same delta from their offsets in the song.
+
+    Args:
+        song_id: ID of the song recognized
+        fingerprints: (hash, time_offset) tuples the song was recognized from
+
+    Returns:
+        The mean delta of the largest 0.5 s bin, as match_fingerprints scores a
+        sample, or None if the song's hashes can't be fetched
+    """
+    try:
+        deltas = offset_deltas(song_hashes(song_id), fingerprints)
+    except LookupError:
+        return None
+    if not len(deltas):
+        return None
+    bins = np.floor(deltas / 0.5)
+    values, counts = np.unique(bins, return_counts=True)
+    return float(deltas[bins == values[counts.argmax()]].mean())
+
+
+def still_playing(song_id: str, alignment: float, recent: list) -> bool:
+    """
+    Check whether recent audio still comes from a previously recognized song.
+
+    Only hashes within ALIGNMENT_TOLERANCE of where the song lined up when it was
+    recognized count, since common hashes occur in most songs at some offset or
+    other; they are scored as a sample's best bin is by recognize_song.
+
+    Args:
+        song_id: ID of the song last recognized for the user
+        alignment: Delta the song was recognized at, from song_alignment
+        recent: (hash, time_offset) tuples of the user's recent audio
+
+    Returns:
+        True if enough of the recent audio lines up with the song
+    """
+    try:
+        known = song_hashes(song_id)
+    except LookupError:
+        return False
+    deltas = offset_deltas(known, recent)
+    aligned = int(np.count_nonzero(np.abs(deltas - alignment) <= ALIGNMENT_TOLERANCE)) if len(deltas) else 0
+    return calculate_confidence(aligned, len(recent)) > 0.5
+
+
+async def recognize_and_notify(uid: str):
+    """
+    Recognize a user's buffered audio and notify them of the result.
+
+    Runs as a background task started by audio_webhook, so the webhook can return
+    while recognition is in progress. Only audio that arrived since the last run is
+    fingerprinted (in the process pool); its hashes are added to the ones kept for
+    the rest of the buffer, and those of the last RECOGNITION_WINDOW seconds are
+    matched against Supabase.
+
+    If those hashes still line up with the last song recognized at the offset it was
+    recognized at, that song is assumed to still be playing: the buffer is cleared
+    and the user isn't notified again. The song's hashes are fetched once and
+    cached, so this skips the Supabase match.
+
+    The caller must have claimed the recognition with audio_buffers.claim; it is
+    released when this finishes, but no sooner than RECOGNITION_INTERVAL seconds
+    after it started. Audio posted in the meantime is only buffered, so a user
+    streaming many small frames gets one recognition per interval rather than
+    one per frame.
+
+    Args:
+        uid: User ID
+    """
+    from abracadabra import settings
+
+    started = time.monotonic()
+    try:
+        # Fingerprint the new audio, with one spectrogram window of overlap so
+        # peaks at the boundary with the last slice aren't lost
+        new_audio = await audio_buffers.read_new_audio(uid, settings.FFT_WINDOW_SIZE)
+        if new_audio is None:
+            return
+        samples, start, sample_rate, processed = new_audio
+        end = start + len(samples)
+
+        loop = asyncio.get_running_loop()
+        new_hashes = await loop.run_in_executor(
+            recognition_executor, fingerprint_slice, samples, sample_rate, start / sample_rate
+        )
+
+        hashes = await audio_buffers.add_hashes(uid, new_hashes, sample_rate, processed, end)
+        if hashes is None:
+            # The buffer was cleared while we were fingerprinting
+            return
+
+        window_start = end / sample_rate - RECOGNITION_WINDOW
+        window = [h for h in hashes if h[1] >= window_start]
+        fields = await audio_buffers.get_fields(uid, 'last_song', 'last_alignment', 'last_recognition')
+        if fields['last_song'] and fields['last_alignment'] is not None and window and await asyncio.to_thread(
+            still_playing, fields['last_song'], fields['last_alignment'], window
+        ):
+            logger.info(f"User {uid} still listening to: {fields['last_recognition']['title']}")
+            await audio_buffers.clear(uid)
+            return
+
+        logger.info(f"Attempting song recognition for user {uid}...")
+        song_info = await asyncio.to_thread(recognize_song, window)
+
+        if song_info and song_info['recognized']:
+            logger.info(f"Song recognized for user {uid}: {song_info}")
+
+            # Send notification to user
+            notification_sent = await send_notification_to_user(uid, song_info)
+
+            if notification_sent:
+                logger.info(f"✅ User {uid} notified about: {song_info['title']}")
+            else:
+                logger.warning(f"⚠️  Could not notify user {uid}")
+
+            # Store last recognition, and where it lines up with the stream, to avoid duplicates
+            alignment = await asyncio.to_thread(song_alignment, song_info['song_id'], window)
+            await audio_buffers.set_fields(uid, last_recognition=song_info, last_song=song_info['song_id'],
+                                           last_alignment=alignment)
+
+            # Clear buffer after successful recognition
+            await audio_buffers.clear(uid)
+        else:
+            logger.info(f"No song recognized for user {uid} (score too low)")
+
+            # Keep accumulating audio for better recognition; the ring buffer
+            # drops anything older than MAX_BUFFER_DURATION
+
+    except Exception as e:
+        logger.error(f"Error recognizing audio for user {uid}: {e}", exc_info=True)
+    finally:
+        try:
+            await asyncio.sleep(started + RECOGNITION_INTERVAL - time.monotonic())
+        finally:
+            await audio_buffers.release(uid)
+
+
 @app.post("/audio")
 async def audio_webhook(
     request: Request,
@@ -291,85 +625,50 @@ async def audio_webhook(
     - sample_rate: 16000 (DevKit1 v1.0.4+/DevKit2) or 8000 (DevKit1 v1.0.2)
     - uid: User's unique identifier
 
-    The audio bytes are accumulated and processed for song recognition.
+    The audio bytes are accumulated and, once there is enough, handed to a
+    background recognition task; the response doesn't wait for the result.
     """
     try:
         # Read raw audio bytes from request body
         audio_bytes = await request.body()
 
-        logger.info(f"Received {len(audio_bytes)} bytes from user {uid} at {sample_rate} Hz")
-
-        # Initialize or append to user's audio buffer
-        if uid not in audio_buffers:
-            audio_buffers[uid] = {
-                'bytes': bytearray(),
-                'sample_rate': sample_rate,
-                'last_recognition': None
-            }
-
-        # Append new bytes to buffer
-        audio_buffers[uid]['bytes'].extend(audio_bytes)
-        audio_buffers[uid]['sample_rate'] = sample_rate
-
-        # Calculate current audio duration in seconds
-        bytes_per_sample = 2  # 16-bit audio = 2 bytes
-        total_samples = len(audio_buffers[uid]['bytes']) / bytes_per_sample
-        duration = total_samples / sample_rate
+        # Append new bytes to the user's audio buffer (creating it if needed)
+        duration = await audio_buffers.append(uid, sample_rate, audio_bytes)
 
-        logger.info(f"User {uid} buffer: {duration:.2f} seconds of audio")
-
-        # Only attempt recognition if we have enough audio
-        if duration >= MIN_AUDIO_LENGTH:
-            # Create temporary WAV file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            temp_dir = tempfile.gettempdir()
-            wav_filename = os.path.join(temp_dir, f"omi_audio_{uid}_{timestamp}.wav")
+        # Omi posts a frame every fraction of a second, so per-frame logging is
+        # debug only, and the message isn't even built unless it's enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received {len(audio_bytes)} bytes from user {uid} at {sample_rate} Hz, "
+                         f"buffer: {duration:.2f} seconds of audio")
 
+        # Only attempt recognition if we have enough audio, and one isn't
+        # already running for this user
+        if duration >= MIN_AUDIO_LENGTH and await audio_buffers.claim(uid):
+            # The claim is released by recognize_and_notify once it's scheduled;
+            # until then, make sure an error here doesn't leave it held
             try:
-                # Convert raw bytes to WAV
-                create_wav_file(
-                    bytes(audio_buffers[uid]['bytes']),
-                    sample_rate,
-                    wav_filename
-                )
-
-                # Recognize song
-                logger.info(f"Attempting song recognition for user {uid}...")
-                song_info = recognize_song(wav_filename)
-
-                if song_info and song_info['recognized']:
-                    logger.info(f"Song recognized for user {uid}: {song_info}")
-
-                    # Send notification to user
-                    notification_sent = send_notification_to_user(uid, song_info)
-
-                    if notification_sent:
-                        logger.info(f"✅ User {uid} notified about: {song_info['title']}")
-                    else:
-                        logger.warning(f"⚠️  Could not notify user {uid}")
-
-                    # Store last recognition to avoid duplicates
-                    audio_buffers[uid]['last_recognition'] = song_info
-
-                    # Clear buffer after successful recognition
-                    audio_buffers[uid]['bytes'] = bytearray()
+                # Don't spend a recognition on silence or background noise
+                recent = await audio_buffers.tail(uid, ACTIVITY_WINDOW)
+                if not is_musiclike(recent, sample_rate):
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Skipping recognition for user {uid}: no music in the last {ACTIVITY_WINDOW}s")
+
+                    # After a long enough silence, a match is no longer "the same song"
+                    last_music = (await audio_buffers.get_fields(uid, 'last_music'))['last_music']
+                    if time.time() - (last_music or 0) > MATCH_CACHE_SILENCE:
+                        await audio_buffers.set_fields(uid, last_song=None)
+
+                    await audio_buffers.release(uid)
                 else:
-                    logger.info(f"No song recognized for user {uid} (score too low)")
-
-                    # Keep accumulating audio for better recognition
-                    # But limit buffer size to prevent memory issues
-                    max_duration = 60  # seconds
-                    if duration > max_duration:
-                        # Keep only the last 30 seconds
-                        samples_to_keep = int(30 * sample_rate * bytes_per_sample)
-                        audio_buffers[uid]['bytes'] = audio_buffers[uid]['bytes'][-samples_to_keep:]
-                        logger.info(f"Trimmed buffer for user {uid} to 30 seconds")
-
-            finally:
-                # Clean up temporary file
-                if os.path.exists(wav_filename):
-                    os.unlink(wav_filename)
-                    logger.info(f"Cleaned up temp file: {wav_filename}")
+                    await audio_buffers.set_fields(uid, last_music=time.time())
+
+                    # Recognize in the background so this request returns straight away
+                    task = asyncio.create_task(recognize_and_notify(uid))
+                    recognition_tasks.add(task)
+                    task.add_done_callback(recognition_tasks.discard)
+            except Exception:
+                await audio_buffers.release(uid)
+                raise
 
         # Return success response
         return JSONResponse(
@@ -405,7 +704,7 @@ async def health_check():
         content={
             "status": "healthy",
             "service": "Omi Song Recognition",
-            "active_users": len(audio_buffers)
+            "active_users": await audio_buffers.count()
         },
         status_code=200
     )
@@ -416,24 +715,24 @@ async def get_user_stats(uid: str):
     """
     Get statistics for a specific user's audio buffer.
     """
-    if uid not in audio_buffers:
+    buffer_info = await audio_buffers.stats(uid)
+    if buffer_info is None:
         return JSONResponse(
             content={"error": "User not found"},
             status_code=404
         )
 
-    buffer_info = audio_buffers[uid]
     bytes_per_sample = 2
-    total_samples = len(buffer_info['bytes']) / bytes_per_sample
+    total_samples = buffer_info['buffer_size_bytes'] / bytes_per_sample
     duration = total_samples / buffer_info['sample_rate']
 
     return JSONResponse(
         content={
             "uid": uid,
-            "buffer_size_bytes": len(buffer_info['bytes']),
+            "buffer_size_bytes": buffer_info['buffer_size_bytes'],
             "buffer_duration_seconds": duration,
             "sample_rate": buffer_info['sample_rate'],
-            "last_recognition": buffer_info.get('last_recognition')
+            "last_recognition": buffer_info['last_recognition']
         },
         status_code=200
     )
@@ -444,8 +743,7 @@ async def clear_buffer(uid: str):
     """
     Clear audio buffer for a specific user.
     """
-    if uid in audio_buffers:
-        del audio_buffers[uid]
+    if await audio_buffers.delete(uid):
         return JSONResponse(
             content={"status": "ok", "message": f"Buffer cleared for user {uid}"},
             status_code=200
@@ -472,20 +770,14 @@ async def register_song(
       -F "artist=Artist Name" \
       -F "title=Song Title"
     """
+    global songs_cache
     try:
         # Save uploaded file temporarily
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-            content = await file.read()
-            tmp.write(content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                tmp.write(chunk)
             tmp_path = tmp.name
 
-        # Rename file if artist and title provided (for metadata extraction)
-        if artist and title:
-            filename = f"1__{artist.replace(' ', '-')}__{title.replace(' ', '-')}{os.path.splitext(file.filename)[1]}"
-            new_path = os.path.join(os.path.dirname(tmp_path), filename)
-            os.rename(tmp_path, new_path)
-            tmp_path = new_path
-
         # Register song using abracadabra with Supabase storage
         try:
             from abracadabra import fingerprint
@@ -493,7 +785,11 @@ async def register_song(
 
             # Generate fingerprints
             logger.info(f"Generating fingerprints for: {tmp_path}")
-            song_fingerprint = fingerprint.fingerprint_file(tmp_path)
+            loop = asyncio.get_running_loop()
+            song_fingerprint = await loop.run_in_executor(
+                recognition_executor, fingerprint.fingerprint_file, tmp_path,
+                upload_song_name(tmp_path, file.filename, artist, title)
+            )
 
             if not song_fingerprint:
                 raise Exception("Failed to generate fingerprints")
@@ -507,8 +803,8 @@ async def register_song(
             final_album = album_meta or "Unknown"
             final_title = title or title_meta or os.path.splitext(file.filename)[0]
 
-            # Extract the actual song_id from fingerprints (UUID-based)
-            # This ensures consistency with the fingerprints stored in hashes table
+            # Extract the actual song_id from fingerprints (UUID-based, from
+            # upload_song_name, so an artist and title always get the same one)
             actual_song_id = song_fingerprint[0][2] if song_fingerprint else None
             
             if not actual_song_id:
@@ -517,7 +813,8 @@ async def register_song(
             # Store in Supabase database
             logger.info(f"Storing {len(song_fingerprint)} fingerprints in Supabase for: {final_artist} - {final_title}")
             logger.info(f"Using song_id from fingerprints: {actual_song_id}")
-            success = supabase_storage.store_song_complete(
+            success = await asyncio.to_thread(
+                supabase_storage.store_song_complete,
                 actual_song_id, song_fingerprint, final_artist, final_album, final_title
             )
 
@@ -529,6 +826,7 @@ async def register_song(
                 raise Exception("Failed to store song in Supabase")
 
             logger.info(f"✅ Song registered in Supabase: {final_artist} - {final_title}")
+            songs_cache = None
             return JSONResponse(
                 content={
                     "status": "success",
@@ -567,12 +865,19 @@ async def register_song(
 async def list_songs():
     """
     List all registered songs in the Supabase database.
+
+    The serialized response is cached for SONGS_CACHE_TTL seconds, since it only
+    changes when a song is registered.
     """
+    global songs_cache
     try:
+        if songs_cache and time.monotonic() - songs_cache[0] < SONGS_CACHE_TTL:
+            return Response(content=songs_cache[1], media_type="application/json")
+
         # Get all songs from Supabase
-        songs_list = supabase_storage.get_all_songs_supabase()
+        songs_list = await asyncio.to_thread(supabase_storage.get_all_songs_supabase)
 
-        return JSONResponse(
+        response = JSONResponse(
             content={
                 "status": "success",
                 "count": len(songs_list),
@@ -583,6 +888,9 @@ async def list_songs():
             },
             status_code=200
         )
+        # An empty list may be a failed query, so it isn't cached
+        songs_cache = (time.monotonic(), response.body) if songs_list else None
+        return response
 
     except Exception as e:
         logger.error(f"Error listing songs: {e}", exc_info=True)
@@ -595,10 +903,15 @@ async def list_songs():
 if __name__ == "__main__":
     import uvicorn
 
-    # Run the server
+    # Run the server with uvloop and httptools (from uvicorn[standard]).
+    # Without REDIS_URL audio buffers live in each worker process, so only raise
+    # WEB_CONCURRENCY then behind a load balancer that pins each uid to one worker.
     uvicorn.run(
-        app,
+        "omi_song_recognition_webhook:app",
         host="0.0.0.0",
         port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
         log_level="info"
     )
@@ -9,6 +9,7 @@ from fastapi.responses import JSONResponse
 import tempfile
 import os
 import subprocess
+import sys
 
 # Add this endpoint to your omi_song_recognition_webhook.py:
 
@@ -41,8 +42,9 @@ async def register_song(
             os.rename(tmp_path, new_path)
             tmp_path = new_path
 
-        # Register song using song_recogniser
-        cmd = ['song_recogniser', 'register', tmp_path]
+        # Register song using song_recogniser, run by this interpreter so it uses
+        # the same environment rather than whichever one is first on PATH
+        cmd = [sys.executable, '-m', 'abracadabra.scripts.song_recogniser', 'register', tmp_path]
         result = subprocess.run(
             cmd,
             capture_output=True,
@@ -22,4 +22,4 @@ fi
 
 # Start the webhook server
 echo "🎵 Starting webhook server on port $PORT..."
-uvicorn omi_song_recognition_webhook:app --host 0.0.0.0 --port ${PORT:-8000}
+uvicorn omi_song_recognition_webhook:app --loop uvloop --http httptools --host 0.0.0.0 --port ${PORT:-8000}
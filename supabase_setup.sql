@@ -2,24 +2,160 @@
 -- Run this SQL in your Supabase SQL Editor to create the required tables
 
 -- song_info table: stores song metadata
+-- song_key is a 64-bit key derived from song_id (the first 8 bytes of its MD5, see
+-- supabase_storage.song_key), which hashes rows carry instead of the ~40 character
+-- song_id text
 CREATE TABLE IF NOT EXISTS song_info (
     artist TEXT,
     album TEXT,
     title TEXT,
-    song_id TEXT
+    song_id TEXT,
+    song_key BIGINT PRIMARY KEY
 );
 
 -- hashes table: stores audio fingerprint hashes
 -- IMPORTANT: time_offset must be REAL/DOUBLE PRECISION (not INTEGER)
 -- because it stores floating-point time values in seconds (e.g., 1.23456)
+-- Rows are only inserted and deleted, never updated, so pages are filled
+-- completely (the default fillfactor of 100); space kept free for updates would
+-- never be used
 CREATE TABLE IF NOT EXISTS hashes (
     fingerprint_hash BIGINT NOT NULL,
     time_offset DOUBLE PRECISION NOT NULL,
-    song_id TEXT NOT NULL
+    song_key BIGINT NOT NULL REFERENCES song_info(song_key)
 );
 
+-- Older setups have no song_key: song_info rows were keyed by song_id alone and
+-- every hashes row stored the song_id text. Move them to song_key before the
+-- indexes below are built on it. On a database created from this file it does nothing
+DO $$
+BEGIN
+    -- song_info: fill in song_key and make it the primary key
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'song_info'::regclass AND contype = 'p') THEN
+        DELETE FROM song_info WHERE song_id IS NULL;
+        DELETE FROM song_info a USING song_info b WHERE a.ctid < b.ctid AND a.song_id = b.song_id;
+        ALTER TABLE song_info ADD COLUMN IF NOT EXISTS song_key BIGINT;
+        UPDATE song_info SET song_key = ('x' || left(md5(song_id), 16))::bit(64)::bigint WHERE song_key IS NULL;
+        ALTER TABLE song_info ADD PRIMARY KEY (song_key);
+    END IF;
+
+    -- hashes: replace the song_id column with song_key. Rows of songs without a
+    -- song_info row could never be matched, and would break the foreign key
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = 'hashes' AND column_name = 'song_id') THEN
+        ALTER TABLE hashes ADD COLUMN IF NOT EXISTS song_key BIGINT;
+        UPDATE hashes SET song_key = ('x' || left(md5(song_id), 16))::bit(64)::bigint WHERE song_key IS NULL;
+        DELETE FROM hashes h WHERE NOT EXISTS (SELECT 1 FROM song_info si WHERE si.song_key = h.song_key);
+        ALTER TABLE hashes ALTER COLUMN song_key SET NOT NULL,
+            ADD FOREIGN KEY (song_key) REFERENCES song_info(song_key),
+            DROP COLUMN song_id;
+    END IF;
+END $$;
+
 -- Indexes for fast fingerprint lookup (critical for performance)
-CREATE INDEX IF NOT EXISTS idx_fingerprint_hash ON hashes(fingerprint_hash);
+-- Covers song_key and time_offset too, so matching reads them from the index
+-- (an index-only scan, once VACUUM has set the visibility map) without visiting
+-- the table
+CREATE INDEX IF NOT EXISTS idx_hashes_cover ON hashes(fingerprint_hash) INCLUDE (song_key, time_offset);
+
+-- All of a song's hashes, for the webhook's still-playing check
+CREATE INDEX IF NOT EXISTS idx_hashes_song ON hashes(song_key);
+
+-- idx_hashes_cover replaces the plain hash index older setups created; drop that
+-- once the covering index exists, so inserts don't maintain both:
+-- DROP INDEX IF EXISTS idx_fingerprint_hash;
+
+-- Refresh the planner's statistics for the indexes. Index-only scans also need the
+-- visibility map, which only VACUUM sets and which can't run inside a transaction:
+-- run VACUUM ANALYZE hashes; on its own after loading songs, or leave it to
+-- autovacuum (init_supabase_tables runs it when DATABASE_URL is set)
+ANALYZE hashes;
+
+-- Older setups took the sample as BIGINT[] and DOUBLE PRECISION[] arrays. That
+-- overload would be left beside this one, so drop it
+DROP FUNCTION IF EXISTS match_fingerprints(BIGINT[], DOUBLE PRECISION[]);
+
+-- Match a sample in one round-trip: score each song by the largest bin of a
+-- histogram of time offset deltas (0.5 s bins), as abracadabra.recognise does.
+-- The sample arrives packed: base64 of big-endian int64 hashes and of
+-- big-endian int32 offsets in milliseconds.
+-- Called by supabase_storage.match_fingerprints_supabase
+CREATE OR REPLACE FUNCTION match_fingerprints(sample_hashes TEXT, sample_offsets TEXT)
+RETURNS TABLE (song_id TEXT, score BIGINT)
+LANGUAGE sql STABLE PARALLEL SAFE AS $$
+    WITH packed AS (
+        SELECT decode(sample_hashes, 'base64') AS hash_bytes,
+               decode(sample_offsets, 'base64') AS offset_bytes
+    ), sample AS (
+        SELECT ('x' || encode(substring(p.hash_bytes FROM i * 8 + 1 FOR 8), 'hex'))::bit(64)::bigint AS fingerprint_hash,
+               ('x' || encode(substring(p.offset_bytes FROM i * 4 + 1 FOR 4), 'hex'))::bit(32)::int / 1000.0 AS time_offset
+        FROM packed p, generate_series(0, length(p.hash_bytes) / 8 - 1) AS i
+    ), matched AS (
+        -- A hash often recurs in a sample; look each one up in the index once
+        SELECT h.fingerprint_hash, h.song_key, h.time_offset
+        FROM (SELECT DISTINCT fingerprint_hash FROM sample) AS q
+        JOIN hashes h ON h.fingerprint_hash = q.fingerprint_hash
+    ), best AS (
+        SELECT deltas.song_key, MAX(deltas.hits) AS score
+        FROM (
+            SELECT m.song_key, COUNT(*) AS hits
+            FROM sample s
+            JOIN matched m ON m.fingerprint_hash = s.fingerprint_hash
+            GROUP BY m.song_key, FLOOR((s.time_offset - m.time_offset) / 0.5)
+        ) AS deltas
+        GROUP BY deltas.song_key
+        ORDER BY score DESC
+        LIMIT 5
+    )
+    SELECT si.song_id, best.score
+    FROM best
+    JOIN song_info si ON si.song_key = best.song_key
+    ORDER BY best.score DESC;
+$$;
+
+-- All of a song's fingerprints, for the webhook's still-playing check. They come
+-- back packed in a single row (base64 of big-endian int64 hashes and of big-endian
+-- float8 offsets, in the same order), so the API's cap on rows per request doesn't
+-- apply and nothing has to be paged
+-- Called by supabase_storage.get_song_hashes_supabase
+CREATE OR REPLACE FUNCTION get_song_hashes(p_song_id TEXT)
+RETURNS TABLE (hashes TEXT, offsets TEXT)
+LANGUAGE sql STABLE PARALLEL SAFE AS $$
+    SELECT encode(coalesce(string_agg(int8send(h.fingerprint_hash), ''::bytea
+                                      ORDER BY h.time_offset, h.fingerprint_hash), ''::bytea), 'base64'),
+           encode(coalesce(string_agg(float8send(h.time_offset), ''::bytea
+                                      ORDER BY h.time_offset, h.fingerprint_hash), ''::bytea), 'base64')
+    FROM hashes h
+    WHERE h.song_key = ('x' || left(md5(p_song_id), 16))::bit(64)::bigint;
+$$;
+
+-- Store a song's metadata and fingerprints in one transaction, so a failed
+-- registration never leaves song_info without its hashes (or the reverse).
+-- Hashes already stored for the song are replaced, so re-registering it does
+-- not count every hash twice. Offsets are passed as a parallel array.
+-- A whole track goes in one call, which can outlast the API roles' statement
+-- timeout; PostgREST applies the function's own statement_timeout before calling it
+-- Called by supabase_storage.store_song_complete
+CREATE OR REPLACE FUNCTION ingest_song(p_song_id TEXT, p_artist TEXT, p_album TEXT, p_title TEXT,
+                                       p_hashes BIGINT[], p_offsets DOUBLE PRECISION[])
+RETURNS void
+LANGUAGE plpgsql
+SET statement_timeout = '5min' AS $$
+DECLARE
+    v_song_key BIGINT := ('x' || left(md5(p_song_id), 16))::bit(64)::bigint;
+BEGIN
+    INSERT INTO song_info (artist, album, title, song_id, song_key)
+    VALUES (p_artist, p_album, p_title, p_song_id, v_song_key)
+    ON CONFLICT (song_key) DO UPDATE
+        SET artist = EXCLUDED.artist, album = EXCLUDED.album, title = EXCLUDED.title;
+
+    DELETE FROM hashes WHERE song_key = v_song_key;
+
+    INSERT INTO hashes (fingerprint_hash, time_offset, song_key)
+    SELECT q.fingerprint_hash, q.time_offset, v_song_key
+    FROM unnest(p_hashes, p_offsets) AS q(fingerprint_hash, time_offset);
+END;
+$$;
 
 -- Grant permissions (if needed for RLS policies)
 -- ALTER TABLE song_info ENABLE ROW LEVEL SECURITY;
@@ -34,5 +170,6 @@ DO $$
 BEGIN
     RAISE NOTICE '✅ Supabase tables created successfully!';
     RAISE NOTICE 'Tables: song_info, hashes';
-    RAISE NOTICE 'Index: idx_fingerprint_hash';
+    RAISE NOTICE 'Index: idx_hashes_cover';
+    RAISE NOTICE 'Functions: match_fingerprints, get_song_hashes, ingest_song';
 END $$;
@@ -5,18 +5,94 @@ Stores songs and fingerprints in Supabase PostgreSQL instead of local SQLite
 """
 
 import os
-from supabase import create_client, Client
+import base64
+import functools
+import hashlib
+import importlib.util
+import json
+import threading
+from collections import OrderedDict
+import httpx
+import numpy as np
+from supabase import create_client, Client, ClientOptions
 from typing import Optional, List, Tuple
 
+# HTTP/2 needs httpx's http2 extra (the h2 package). Only whether it is installed
+# matters, as httpx imports it itself
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+try:
+    import psycopg
+    from psycopg_pool import ConnectionPool
+    PSYCOPG_AVAILABLE = True
+except ImportError:
+    PSYCOPG_AVAILABLE = False
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
 # Initialize Supabase client
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
+# Direct Postgres connection string for the Supabase database (optional). When set
+# and psycopg is installed, matching and hash lookups run as SQL on pooled
+# connections, and fingerprints are bulk loaded with COPY, instead of going
+# through the REST API. Use the direct or session-mode connection string: queries
+# are prepared on first use, and prepared statements don't survive a
+# transaction-mode pooler
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Redis shared by the webhook workers (optional). When set, song metadata looked
+# up by any worker is cached there for the others
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Seconds song metadata stays in the Redis cache
+SONG_INFO_TTL = 24 * 60 * 60
+
+# Talk to Supabase over HTTP/2 (needs the h2 package, from httpx[http2]); set to 0
+# to fall back to HTTP/1.1 keep-alive
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "1") == "1"
+
 if SUPABASE_URL and SUPABASE_KEY:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    # One pooled connection reused by every query and insert, instead of a new
+    # TCP + TLS handshake whenever the pool has gone idle
+    http_client = httpx.Client(
+        http2=SUPABASE_HTTP2 and HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60),
+        timeout=120
+    )
+    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
 else:
     supabase = None
 
+if DATABASE_URL and PSYCOPG_AVAILABLE:
+    postgres_pool = ConnectionPool(DATABASE_URL, min_size=2, max_size=10,
+                                   kwargs={"prepare_threshold": 0}, open=True)
+else:
+    postgres_pool = None
+
+if REDIS_URL and REDIS_AVAILABLE:
+    metadata_cache = redis.Redis.from_url(REDIS_URL)
+else:
+    metadata_cache = None
+
+# A hashes row in PostgreSQL's binary COPY format: the field count, then each
+# field's length and big-endian value. Rows are laid out with numpy so the
+# COPY payload is built without per-row Python calls
+COPY_ROW_DTYPE = np.dtype([
+    ("fields", ">i2"),
+    ("hash_len", ">i4"), ("fingerprint_hash", ">i8"),
+    ("offset_len", ">i4"), ("time_offset", ">f8"),
+    ("key_len", ">i4"), ("song_key", ">i8"),
+])
+# Signature, flags and header extension length; the trailer is a field count of -1
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+COPY_TRAILER = b"\xff\xff"
+
 # SQL schema for Supabase tables
 # Based on abracadabra's SQLite structure with PostgreSQL-safe naming:
 #   SQLite "hash" table → Supabase "hashes" table
@@ -24,27 +100,164 @@ else:
 #   SQLite "offset" column → Supabase "time_offset" column (avoids keyword)
 SCHEMA_SQL = """
 -- song_info table
+-- song_key is a 64-bit key derived from song_id (the first 8 bytes of its MD5, see
+-- supabase_storage.song_key), which hashes rows carry instead of the ~40 character
+-- song_id text
 CREATE TABLE IF NOT EXISTS song_info (
     artist TEXT,
     album TEXT,
     title TEXT,
-    song_id TEXT
+    song_id TEXT,
+    song_key BIGINT PRIMARY KEY
 );
 
 -- hashes table (avoids "hash" and "offset" keywords)
 -- IMPORTANT: time_offset is DOUBLE PRECISION (not INTEGER) for floating-point time values
+-- Rows are only inserted and deleted, never updated, so pages are filled
+-- completely (the default fillfactor of 100); space kept free for updates would
+-- never be used
 CREATE TABLE IF NOT EXISTS hashes (
     fingerprint_hash BIGINT NOT NULL,
     time_offset DOUBLE PRECISION NOT NULL,
-    song_id TEXT NOT NULL
+    song_key BIGINT NOT NULL REFERENCES song_info(song_key)
 );
 
+-- Older setups have no song_key: song_info rows were keyed by song_id alone and
+-- every hashes row stored the song_id text. Move them to song_key before the
+-- indexes below are built on it. On a database created from this file it does nothing
+DO $$
+BEGIN
+    -- song_info: fill in song_key and make it the primary key
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'song_info'::regclass AND contype = 'p') THEN
+        DELETE FROM song_info WHERE song_id IS NULL;
+        DELETE FROM song_info a USING song_info b WHERE a.ctid < b.ctid AND a.song_id = b.song_id;
+        ALTER TABLE song_info ADD COLUMN IF NOT EXISTS song_key BIGINT;
+        UPDATE song_info SET song_key = ('x' || left(md5(song_id), 16))::bit(64)::bigint WHERE song_key IS NULL;
+        ALTER TABLE song_info ADD PRIMARY KEY (song_key);
+    END IF;
+
+    -- hashes: replace the song_id column with song_key. Rows of songs without a
+    -- song_info row could never be matched, and would break the foreign key
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = 'hashes' AND column_name = 'song_id') THEN
+        ALTER TABLE hashes ADD COLUMN IF NOT EXISTS song_key BIGINT;
+        UPDATE hashes SET song_key = ('x' || left(md5(song_id), 16))::bit(64)::bigint WHERE song_key IS NULL;
+        DELETE FROM hashes h WHERE NOT EXISTS (SELECT 1 FROM song_info si WHERE si.song_key = h.song_key);
+        ALTER TABLE hashes ALTER COLUMN song_key SET NOT NULL,
+            ADD FOREIGN KEY (song_key) REFERENCES song_info(song_key),
+            DROP COLUMN song_id;
+    END IF;
+END $$;
+
 -- Index for fast lookup
-CREATE INDEX IF NOT EXISTS idx_fingerprint_hash ON hashes(fingerprint_hash);
+-- Covers song_key and time_offset too, so matching reads them from the index
+-- (an index-only scan, once VACUUM has set the visibility map) without visiting
+-- the table
+CREATE INDEX IF NOT EXISTS idx_hashes_cover ON hashes(fingerprint_hash) INCLUDE (song_key, time_offset);
+
+-- All of a song's hashes, for the webhook's still-playing check
+CREATE INDEX IF NOT EXISTS idx_hashes_song ON hashes(song_key);
+
+-- idx_hashes_cover replaces the plain hash index older setups created; drop that
+-- once the covering index exists, so inserts don't maintain both:
+-- DROP INDEX IF EXISTS idx_fingerprint_hash;
+
+-- Refresh the planner's statistics for the indexes. Index-only scans also need the
+-- visibility map, which only VACUUM sets and which can't run inside a transaction:
+-- run VACUUM ANALYZE hashes; on its own after loading songs, or leave it to
+-- autovacuum (init_supabase_tables runs it when DATABASE_URL is set)
+ANALYZE hashes;
+
+-- Older setups took the sample as BIGINT[] and DOUBLE PRECISION[] arrays. That
+-- overload would be left beside this one, so drop it
+DROP FUNCTION IF EXISTS match_fingerprints(BIGINT[], DOUBLE PRECISION[]);
+
+-- Match a sample in one round-trip: score each song by the largest bin of a
+-- histogram of time offset deltas (0.5 s bins), as abracadabra.recognise does.
+-- The sample arrives packed: base64 of big-endian int64 hashes and of
+-- big-endian int32 offsets in milliseconds
+CREATE OR REPLACE FUNCTION match_fingerprints(sample_hashes TEXT, sample_offsets TEXT)
+RETURNS TABLE (song_id TEXT, score BIGINT)
+LANGUAGE sql STABLE PARALLEL SAFE AS $$
+    WITH packed AS (
+        SELECT decode(sample_hashes, 'base64') AS hash_bytes,
+               decode(sample_offsets, 'base64') AS offset_bytes
+    ), sample AS (
+        SELECT ('x' || encode(substring(p.hash_bytes FROM i * 8 + 1 FOR 8), 'hex'))::bit(64)::bigint AS fingerprint_hash,
+               ('x' || encode(substring(p.offset_bytes FROM i * 4 + 1 FOR 4), 'hex'))::bit(32)::int / 1000.0 AS time_offset
+        FROM packed p, generate_series(0, length(p.hash_bytes) / 8 - 1) AS i
+    ), matched AS (
+        -- A hash often recurs in a sample; look each one up in the index once
+        SELECT h.fingerprint_hash, h.song_key, h.time_offset
+        FROM (SELECT DISTINCT fingerprint_hash FROM sample) AS q
+        JOIN hashes h ON h.fingerprint_hash = q.fingerprint_hash
+    ), best AS (
+        SELECT deltas.song_key, MAX(deltas.hits) AS score
+        FROM (
+            SELECT m.song_key, COUNT(*) AS hits
+            FROM sample s
+            JOIN matched m ON m.fingerprint_hash = s.fingerprint_hash
+            GROUP BY m.song_key, FLOOR((s.time_offset - m.time_offset) / 0.5)
+        ) AS deltas
+        GROUP BY deltas.song_key
+        ORDER BY score DESC
+        LIMIT 5
+    )
+    SELECT si.song_id, best.score
+    FROM best
+    JOIN song_info si ON si.song_key = best.song_key
+    ORDER BY best.score DESC;
+$$;
+
+-- All of a song's fingerprints, for the webhook's still-playing check. They come
+-- back packed in a single row (base64 of big-endian int64 hashes and of big-endian
+-- float8 offsets, in the same order), so the API's cap on rows per request doesn't
+-- apply and nothing has to be paged
+CREATE OR REPLACE FUNCTION get_song_hashes(p_song_id TEXT)
+RETURNS TABLE (hashes TEXT, offsets TEXT)
+LANGUAGE sql STABLE PARALLEL SAFE AS $$
+    SELECT encode(coalesce(string_agg(int8send(h.fingerprint_hash), ''::bytea
+                                      ORDER BY h.time_offset, h.fingerprint_hash), ''::bytea), 'base64'),
+           encode(coalesce(string_agg(float8send(h.time_offset), ''::bytea
+                                      ORDER BY h.time_offset, h.fingerprint_hash), ''::bytea), 'base64')
+    FROM hashes h
+    WHERE h.song_key = ('x' || left(md5(p_song_id), 16))::bit(64)::bigint;
+$$;
+
+-- Store a song's metadata and fingerprints in one transaction, so a failed
+-- registration never leaves song_info without its hashes (or the reverse).
+-- Hashes already stored for the song are replaced, so re-registering it does
+-- not count every hash twice. Offsets are passed as a parallel array.
+-- A whole track goes in one call, which can outlast the API roles' statement
+-- timeout; PostgREST applies the function's own statement_timeout before calling it
+CREATE OR REPLACE FUNCTION ingest_song(p_song_id TEXT, p_artist TEXT, p_album TEXT, p_title TEXT,
+                                       p_hashes BIGINT[], p_offsets DOUBLE PRECISION[])
+RETURNS void
+LANGUAGE plpgsql
+SET statement_timeout = '5min' AS $$
+DECLARE
+    v_song_key BIGINT := ('x' || left(md5(p_song_id), 16))::bit(64)::bigint;
+BEGIN
+    INSERT INTO song_info (artist, album, title, song_id, song_key)
+    VALUES (p_artist, p_album, p_title, p_song_id, v_song_key)
+    ON CONFLICT (song_key) DO UPDATE
+        SET artist = EXCLUDED.artist, album = EXCLUDED.album, title = EXCLUDED.title;
+
+    DELETE FROM hashes WHERE song_key = v_song_key;
+
+    INSERT INTO hashes (fingerprint_hash, time_offset, song_key)
+    SELECT q.fingerprint_hash, q.time_offset, v_song_key
+    FROM unnest(p_hashes, p_offsets) AS q(fingerprint_hash, time_offset);
+END;
+$$;
 """
 
 def init_supabase_tables():
-    """Initialize Supabase tables if they don't exist"""
+    """Initialize Supabase tables if they don't exist
+
+    With DATABASE_URL set, also refreshes the hashes table's statistics and visibility
+    map, which the planner needs to pick index-only scans on idx_hashes_cover.
+    """
     if not supabase:
         print("⚠️  Supabase not configured")
         return False
@@ -55,61 +268,66 @@ def init_supabase_tables():
         print("✅ Supabase connected")
         print("📝 Run this SQL in Supabase SQL Editor to create tables:")
         print(SCHEMA_SQL)
+
+        if postgres_pool:
+            # VACUUM can't run inside a transaction, so not on a pooled connection
+            with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+                conn.execute("VACUUM ANALYZE hashes")
         return True
     except Exception as e:
         print(f"❌ Supabase initialization error: {e}")
         return False
 
-def store_song_supabase(song_id: str, artist: str, album: str, title: str):
-    """Store song metadata in Supabase"""
-    if not supabase:
-        return False
+@functools.lru_cache(maxsize=1024)
+def song_key(song_id: str) -> int:
+    """
+    Get the 64-bit key a song's rows are stored under: the first 8 bytes of the
+    MD5 of its song_id, as a signed integer (the same as the schema's
+    ('x' || left(md5(song_id), 16))::bit(64)::bigint).
+    """
+    return int.from_bytes(hashlib.md5(song_id.encode()).digest()[:8], 'big', signed=True)
 
-    try:
-        data = {
-            "song_id": song_id,
-            "artist": artist,
-            "album": album,
-            "title": title
-        }
-        result = supabase.table("song_info").upsert(data).execute()
-        return True
-    except Exception as e:
-        print(f"Error storing song: {e}")
-        return False
 
-def store_fingerprints_supabase(song_id: str, fingerprints: List[Tuple[int, int, str]]):
-    """Store fingerprints in Supabase
-    
+def forget_song_info(song_id: str):
+    """Drop cached metadata for a song, since re-registering it can change it"""
+    with song_info_lock:
+        song_info_cache.pop(song_id, None)
+    if metadata_cache:
+        try:
+            metadata_cache.delete(f"omi:song:{song_id}")
+        except redis.RedisError as e:
+            print(f"Error clearing song metadata cache: {e}")
+
+
+def query_postgres(sql: str, params: tuple) -> list:
+    """Run a query on a pooled direct connection and return its rows as tuples"""
+    with postgres_pool.connection() as conn, conn.cursor(binary=True) as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+def copy_fingerprints_postgres(conn, fingerprints: List[Tuple[int, int, str]]):
+    """
+    Bulk load fingerprints straight into the hashes table with binary COPY.
+
     Args:
-        song_id: The song ID (ignored, uses the one from fingerprints)
+        conn: Connection to copy on; rows commit with its transaction
         fingerprints: List of (hash, time_offset, song_id) tuples from fingerprint_file()
     """
-    if not supabase:
-        return False
+    count = len(fingerprints)
+    rows = np.empty(count, dtype=COPY_ROW_DTYPE)
+    rows["fields"] = 3
+    rows["hash_len"] = rows["offset_len"] = rows["key_len"] = 8
+    rows["fingerprint_hash"] = np.fromiter((fp[0] for fp in fingerprints), dtype=np.int64, count=count)
+    rows["time_offset"] = np.fromiter((fp[1] for fp in fingerprints), dtype=np.float64, count=count)
+    rows["song_key"] = np.fromiter((song_key(fp[2]) for fp in fingerprints), dtype=np.int64, count=count)
 
-    try:
-        # Batch insert fingerprints
-        # Fingerprints come as (hash, time_offset, song_id) tuples
-        data = [
-            {
-                "fingerprint_hash": fp_hash,
-                "time_offset": float(time_offset),
-                "song_id": fp_song_id
-            }
-            for fp_hash, time_offset, fp_song_id in fingerprints
-        ]
-
-        # Insert in batches of 1000
-        batch_size = 1000
-        for i in range(0, len(data), batch_size):
-            batch = data[i:i+batch_size]
-            supabase.table("hashes").insert(batch).execute()
+    with conn.cursor() as cur:
+        with cur.copy("COPY hashes (fingerprint_hash, time_offset, song_key) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.write(COPY_HEADER)
+            copy.write(rows.tobytes())
+            copy.write(COPY_TRAILER)
 
-        return True
-    except Exception as e:
-        print(f"Error storing fingerprints: {e}")
-        return False
 
 def get_song_by_id_supabase(song_id: str) -> Optional[Tuple[str, str, str]]:
     """Get song metadata from Supabase"""
@@ -127,75 +345,188 @@ def get_song_by_id_supabase(song_id: str) -> Optional[Tuple[str, str, str]]:
         return None
 
 def list_all_songs_supabase() -> List[Tuple[str, str, str]]:
-    """List all songs from Supabase"""
-    if not supabase:
+    """List all songs from Supabase
+
+    With DATABASE_URL set they come from one direct query. Otherwise rows are fetched
+    a page at a time, since the API caps how many rows one request returns.
+    """
+    if not supabase and not postgres_pool:
         return []
 
     try:
-        result = supabase.table("song_info").select("artist,album,title").execute()
-        return [(s['artist'], s['album'], s['title']) for s in result.data]
+        if postgres_pool:
+            return query_postgres("SELECT artist, album, title FROM song_info ORDER BY song_id", ())
+
+        page_size = 1000
+        songs = []
+        while True:
+            result = (
+                supabase.table("song_info")
+                .select("artist,album,title")
+                .order("song_id")
+                .range(len(songs), len(songs) + page_size - 1)
+                .execute()
+            )
+            songs.extend((s['artist'], s['album'], s['title']) for s in result.data or [])
+            if len(result.data or []) < page_size:
+                return songs
     except Exception as e:
         print(f"Error listing songs: {e}")
         return []
 
 
-def get_matches_supabase(fingerprints: List[Tuple[int, int]]) -> List[str]:
+def match_fingerprints_supabase(fingerprints: List[Tuple[int, float]]) -> List[Tuple[str, int]]:
     """
-    Match fingerprints against database and return list of matching song_ids.
+    Score the songs matching a sample's fingerprints with the match_fingerprints RPC.
+
+    The database joins the hashes, histograms the time offset deltas for each song and
+    returns the best scores, so only a handful of rows come back. The sample is sent
+    packed, as int64 hashes and int32 millisecond offsets, rather than as JSON numbers.
+    With DATABASE_URL set the function is called directly rather than through the API.
 
     Args:
-        fingerprints: List of (hash, time_offset) tuples
+        fingerprints: List of (hash, time_offset) tuples, e.g. from fingerprint_file()
 
     Returns:
-        List of song_ids that match the fingerprints
+        List of up to 5 (song_id, score) tuples, best first
     """
-    if not supabase:
+    if not fingerprints or (not supabase and not postgres_pool):
         return []
 
     try:
-        # Extract just the hashes for matching
-        hash_values = [fp[0] for fp in fingerprints]
+        count = len(fingerprints)
+        hashes = np.fromiter((fp[0] for fp in fingerprints), dtype='>i8', count=count)
+        offsets = np.fromiter((fp[1] for fp in fingerprints), dtype=np.float64, count=count)
+        offsets_ms = np.rint(offsets * 1000).astype('>i4')
+
+        sample_hashes = base64.b64encode(hashes.tobytes()).decode()
+        sample_offsets = base64.b64encode(offsets_ms.tobytes()).decode()
+
+        if postgres_pool:
+            return query_postgres("SELECT song_id, score FROM match_fingerprints(%s, %s)",
+                                  (sample_hashes, sample_offsets))
+
+        result = supabase.rpc("match_fingerprints", {
+            "sample_hashes": sample_hashes,
+            "sample_offsets": sample_offsets
+        }).execute()
+        return [(row['song_id'], row['score']) for row in result.data or []]
+    except Exception as e:
+        print(f"Error matching fingerprints: {e}")
+        return []
 
-        # Query database for matching hashes (batch query)
-        # Note: Supabase has a limit on IN clause size, so we batch if needed
-        batch_size = 1000
-        all_matches = []
 
-        for i in range(0, len(hash_values), batch_size):
-            batch_hashes = hash_values[i:i+batch_size]
-            result = supabase.table("hashes").select("song_id").in_("fingerprint_hash", batch_hashes).execute()
+def get_song_hashes_supabase(song_id: str) -> List[Tuple[int, float]]:
+    """
+    Get every fingerprint stored for a song.
+
+    With DATABASE_URL set they come from one direct query. Otherwise the
+    get_song_hashes RPC returns them all packed into one row.
+
+    Args:
+        song_id: Song to fetch the fingerprints of
 
-            if result.data:
-                all_matches.extend([row['song_id'] for row in result.data])
+    Returns:
+        List of the song's (hash, time_offset) tuples, or an empty list if it has none
+        or the query fails
+    """
+    if not supabase and not postgres_pool:
+        return []
 
-        return all_matches
+    try:
+        if postgres_pool:
+            return query_postgres("SELECT fingerprint_hash, time_offset FROM hashes WHERE song_key = %s",
+                                  (song_key(song_id),))
+
+        result = supabase.rpc("get_song_hashes", {"p_song_id": song_id}).execute()
+        if not result.data:
+            return []
+        packed = result.data[0]
+        hashes = np.frombuffer(base64.b64decode(packed['hashes']), dtype='>i8')
+        offsets = np.frombuffer(base64.b64decode(packed['offsets']), dtype='>f8')
+        return list(zip(hashes.tolist(), offsets.tolist()))
     except Exception as e:
-        print(f"Error matching fingerprints: {e}")
+        print(f"Error getting song hashes: {e}")
         return []
 
 
+# Songs whose metadata is kept in memory by get_song_info_supabase
+SONG_INFO_CACHE_SIZE = 4096
+
+# song_id -> (artist, album, title), least recently used first. Shared by the
+# webhook's recognition threads, hence the lock
+song_info_cache = OrderedDict()
+song_info_lock = threading.Lock()
+
+
+def lookup_song_info(song_id: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Get song metadata from the shared Redis cache (if REDIS_URL is set), falling back
+    to Supabase. Supabase results are stored in Redis for other workers, and Redis
+    errors only skip the shared cache.
+    """
+    cache_key = f"omi:song:{song_id}"
+    if metadata_cache:
+        try:
+            cached = metadata_cache.get(cache_key)
+            if cached is not None:
+                return tuple(json.loads(cached))
+        except redis.RedisError as e:
+            print(f"Error reading song metadata cache: {e}")
+
+    song_info = get_song_by_id_supabase(song_id)
+    if song_info is not None and metadata_cache:
+        try:
+            metadata_cache.set(cache_key, json.dumps(song_info), ex=SONG_INFO_TTL)
+        except redis.RedisError as e:
+            print(f"Error writing song metadata cache: {e}")
+    return song_info
+
+
 def get_song_info_supabase(song_id: str) -> Optional[Tuple[str, str, str]]:
-    """Get song metadata (artist, album, title) from Supabase"""
-    return get_song_by_id_supabase(song_id)
+    """
+    Get song metadata (artist, album, title) from Supabase, kept in memory after the
+    first lookup (up to SONG_INFO_CACHE_SIZE songs). Songs that aren't found aren't
+    cached, so they are looked up again once registered.
+    """
+    with song_info_lock:
+        song_info = song_info_cache.get(song_id)
+        if song_info is not None:
+            song_info_cache.move_to_end(song_id)
+            return song_info
+
+    song_info = lookup_song_info(song_id)
+    if song_info is not None:
+        with song_info_lock:
+            song_info_cache[song_id] = song_info
+            if len(song_info_cache) > SONG_INFO_CACHE_SIZE:
+                song_info_cache.popitem(last=False)
+    return song_info
+
+
+def clear_song_info_cache():
+    """Forget every song's metadata held in memory by get_song_info_supabase"""
+    with song_info_lock:
+        song_info_cache.clear()
 
 
 def get_song_id_from_path(filepath: str) -> str:
     """
     Generate a unique song ID from filepath.
-    Uses the same logic as abracadabra.storage.get_song_id()
+    Uses the same logic as abracadabra.fingerprint.hash_points(), so it is the
+    song_id the song's fingerprints (and its song_info row) are stored under
     """
-    import hashlib
-    from pathlib import Path
+    import uuid
 
-    # Use filename as basis for song ID
-    filename = Path(filepath).name
-    return hashlib.md5(filename.encode()).hexdigest()
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, filepath).int)
 
 
 def store_song_complete(song_id: str, fingerprints: List[Tuple[int, int, str]],
                        artist: str, album: str, title: str) -> bool:
     """
-    Store both song metadata and fingerprints in Supabase.
+    Store both song metadata and fingerprints in Supabase, atomically.
+
+    Any hashes already stored for the song are replaced.
 
     Args:
         song_id: Unique identifier for the song (IGNORED - uses song_id from fingerprints)
@@ -220,15 +551,29 @@ def store_song_complete(song_id: str, fingerprints: List[Tuple[int, int, str]],
         
         actual_song_id = fingerprints[0][2]  # Get song_id from first fingerprint
         print(f"📝 Storing song with ID: {actual_song_id} ({artist} - {title})")
-        
-        # Store song metadata with the actual song_id from fingerprints
-        success = store_song_supabase(actual_song_id, artist, album, title)
-        if not success:
-            return False
 
-        # Store fingerprints
-        success = store_fingerprints_supabase(actual_song_id, fingerprints)
-        return success
+        # ingest_song writes the metadata and hashes in one transaction, so a
+        # failure part way through leaves no half-registered song behind
+        if postgres_pool:
+            # Let ingest_song store the metadata, then COPY the hashes before the
+            # connection commits
+            with postgres_pool.connection() as conn:
+                conn.execute(
+                    "SELECT ingest_song(%s, %s, %s, %s, '{}', '{}')",
+                    (actual_song_id, artist, album, title)
+                )
+                copy_fingerprints_postgres(conn, fingerprints)
+        else:
+            supabase.rpc("ingest_song", {
+                "p_song_id": actual_song_id,
+                "p_artist": artist,
+                "p_album": album,
+                "p_title": title,
+                "p_hashes": [fp_hash for fp_hash, _, _ in fingerprints],
+                "p_offsets": [float(time_offset) for _, time_offset, _ in fingerprints],
+            }).execute()
+        forget_song_info(actual_song_id)
+        return True
     except Exception as e:
         print(f"Error storing song: {e}")
         return False